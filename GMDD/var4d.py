@@ -28,7 +28,7 @@ def optimize(rcfile, setuponly=False, verbosity='INFO'):
     # Load the observations database
     db = obsdb(filename=obsfile, start=start, end=end)
     if rcf.get('footprints.setup', default=True):
-        db.setupFootprints(path=rcf.get('footprints.path'), cache=rcf.get('footprints.cache'))
+        db.setupFootprints(path=rcf.get('footprints.path'), cache=rcf.get('footprints.cache'), staging_workers=rcf.get('footprints.cache.workers', default=8))
 
     # Eventual refinement of the obs sites selection:
     if rcf.get("observations.use_sites", default=False):
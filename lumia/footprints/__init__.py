@@ -0,0 +1,7 @@
+#!/usr/bin/env python
+
+from .footprint import Footprint
+from .operator import SparseOperator
+from .pool import FootprintPool
+from .index import FootprintIndex
+from .cache import FootprintCache
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import zlib
+import logging
+from collections import OrderedDict
+from numpy import frombuffer
+from .footprint import FootprintBlock
+
+try :
+    import blosc
+except ImportError :
+    blosc = None
+
+logger = logging.getLogger(__name__)
+
+
+class FootprintCache:
+    """
+    In-memory cache of FootprintBlocks, with a maximum size (in bytes) and least-recently-used eviction.
+    The blocks can optionally be stored compressed ("zlib" or "blosc" compression, the latter only if the blosc module
+    is installed), to fit more footprints in memory at the cost of decompressing them at each use.
+    """
+    def __init__(self, max_bytes, compression=None):
+        self.max_bytes = max_bytes
+        if compression == 'blosc' and blosc is None :
+            logger.warning("The blosc module is not available, the footprint cache will use zlib compression instead")
+            compression = 'zlib'
+        self.compression = compression
+        self.blocks = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def compress(self, data):
+        if self.compression == 'blosc' :
+            return blosc.compress(data.tobytes(), typesize=data.dtype.itemsize)
+        return zlib.compress(data.tobytes(), 1)
+
+    def decompress(self, data, dtype):
+        if self.compression == 'blosc' :
+            return frombuffer(blosc.decompress(data), dtype=dtype)
+        return frombuffer(zlib.decompress(data), dtype=dtype)
+
+    def pack(self, block):
+        """
+        Convert a FootprintBlock to the stored representation. Returns the stored object and its size in bytes.
+        """
+        if self.compression is None :
+            return block, block.valid.nbytes+block.offsets.nbytes+block.index.nbytes+block.resp.nbytes
+        index = self.compress(block.index)
+        resp = self.compress(block.resp)
+        packed = (block.valid, block.offsets, index, block.index.dtype, resp, block.resp.dtype)
+        return packed, block.valid.nbytes+block.offsets.nbytes+len(index)+len(resp)
+
+    def unpack(self, packed):
+        if self.compression is None :
+            return packed
+        valid, offsets, index, index_dtype, resp, resp_dtype = packed
+        return FootprintBlock(valid, offsets, self.decompress(index, index_dtype), self.decompress(resp, resp_dtype))
+
+    def get(self, key, loader):
+        """
+        Return the block stored under "key", or load it by calling "loader()" and store it if it isn't in the cache
+        """
+        if key in self.blocks :
+            self.hits += 1
+            self.blocks.move_to_end(key)
+            return self.unpack(self.blocks[key][0])
+
+        self.misses += 1
+        block = loader()
+        packed, nbytes = self.pack(block)
+        if nbytes <= self.max_bytes :
+            while self.nbytes+nbytes > self.max_bytes :
+                _, (_, evicted) = self.blocks.popitem(last=False)
+                self.nbytes -= evicted
+            self.blocks[key] = (packed, nbytes)
+            self.nbytes += nbytes
+        return block
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'nbytes': self.nbytes, 'nblocks': len(self.blocks)}
+
+    def __repr__(self):
+        ratio = self.hits/max(self.hits+self.misses, 1)
+        return f"footprint cache: {self.hits} hits, {self.misses} misses ({ratio:.0%} hit rate), {len(self.blocks)} blocks, {self.nbytes/1.e6:.1f} MB"
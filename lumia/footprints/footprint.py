@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+import os
+import logging
+import h5py
+from numpy import concatenate, full, zeros, repeat, arange, diff, int64
+from .storage import ConsolidatedStore, is_consolidated
+
+logger = logging.getLogger(__name__)
+
+
+def timesIndex(times_start, times_end):
+    """
+    Map the emission time intervals to their index on the emission time axis. The keys are formatted as the names of
+    the footprint time step groups ("YYYYmmddHHMMSS_YYYYmmddHHMMSS", end of the interval first), so that the footprint
+    time steps can be looked up without parsing their names.
+    """
+    return {f"{t2:%Y%m%d%H%M%S}_{t1:%Y%m%d%H%M%S}": it for (it, (t1, t2)) in enumerate(zip(times_start, times_end))}
+
+
+class FootprintBlock:
+    """
+    Footprints of a set of observations from a same file, stored as flat arrays:
+    - valid : flags the observations with a footprint (False if the footprint is missing or outside the emission period)
+    - offsets : the footprint elements of the i-th observation are in the [offsets[i]:offsets[i+1]] slice of the arrays
+    - index : flat index of each footprint element in the (nt, nlat, nlon) emission grid
+    - resp : sensitivity of each footprint element
+    """
+    def __init__(self, valid, offsets, index, resp):
+        self.valid = valid
+        self.offsets = offsets
+        self.index = index
+        self.resp = resp
+
+    @property
+    def nobs(self):
+        return len(self.valid)
+
+    @property
+    def obs(self):
+        """
+        Position (in the block) of the observation corresponding to each footprint element
+        """
+        return repeat(arange(self.nobs), diff(self.offsets))
+
+
+class Footprint:
+    def __init__(self, fpfile, path='', open=True):
+        self.filename = fpfile
+        if not os.path.exists(self.filename):
+            logger.warning('Footprint file not found: %s'%self.filename)
+        self.ds = h5py.File(fpfile, 'r')
+        self.varname = None
+
+        # Files in the consolidated format are read through a ConsolidatedStore
+        self.store = ConsolidatedStore(self.ds) if is_consolidated(self.ds) else None
+
+    def close(self):
+        self.ds.close()
+
+    def readIndices(self, group):
+        """
+        Return the lat and lon indices of a footprint time step (the datasets are named either ilats/ilons or ilat/ilon)
+        """
+        try :
+            return group['ilats'][:], group['ilons'][:]
+        except KeyError :
+            try :
+                return group['ilat'][:], group['ilon'][:]
+            except KeyError :
+                logger.error(f"Error reading ilats/ilons from footprint {self.varname} in file {self.filename}")
+                raise KeyError
+
+    def readObs(self, time, times_index):
+        """
+        Read the footprint of the observation at "time" as flat arrays of time, latitude and longitude indices and of
+        sensitivities. The time indices are looked up in "times_index", a dictionary mapping the footprint group names
+        to emission time indices (see timesIndex).
+        Returns None if the footprint doesn't exist, or if it is (even partly) outside of the emission time axis.
+        """
+        self.varname = time.strftime('%Y%m%d%H%M%S')
+        if self.store is not None :
+            return self.store.readObs(self.varname, times_index)
+        if not self.varname in self.ds :
+            return None
+        obs = self.ds[self.varname]
+        itimes, ilats, ilons, resp = [], [], [], []
+        for tt in obs :
+            # Groups named as tmin_tmax shouldn't be used (old and wrong!). Both parts have the same fixed-width
+            # format, so they can be compared as strings
+            t1, t2 = tt.split('_')
+            if t2 >= t1 :
+                continue
+            if tt not in times_index :
+                return None
+            ila, ilo = self.readIndices(obs[tt])
+            itimes.append(full(len(ila), times_index[tt]))
+            ilats.append(ila)
+            ilons.append(ilo)
+            resp.append(obs[tt]['resp'][:])
+        if len(resp) == 0 : return None
+        return concatenate(itimes), concatenate(ilats), concatenate(ilons), concatenate(resp)
+
+    def readBlock(self, times, times_index, shape):
+        """
+        Read the footprints of all the observations at "times" in one FootprintBlock. "shape" is the (nt, nlat, nlon)
+        shape of the emission grid, and "times_index" maps the footprint time steps to the emission time steps.
+        """
+        if self.store is not None :
+            names = [time.strftime('%Y%m%d%H%M%S') for time in times]
+            return FootprintBlock(*self.store.readBlock(names, times_index, shape))
+
+        nt, nlat, nlon = shape
+        valid = zeros(len(times), dtype=bool)
+        counts = zeros(len(times), dtype=int64)
+        index, resp = [], []
+        for iobs, time in enumerate(times):
+            data = self.readObs(time, times_index)
+            if data is None : continue
+            itimes, ilats, ilons, values = data
+            valid[iobs] = True
+            counts[iobs] = len(values)
+            index.append((itimes.astype(int64)*nlat+ilats)*nlon+ilons)
+            resp.append(values)
+        offsets = concatenate(([0], counts.cumsum()))
+        if len(resp) == 0 :
+            return FootprintBlock(valid, offsets, zeros(0, dtype=int64), zeros(0))
+        return FootprintBlock(valid, offsets, concatenate(index), concatenate(resp))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""
+Persistent index of the footprint files content.
+
+For each observation footprint of each indexed file, the index records its number of (valid) time steps, its number
+of elements, the time span it covers and its total sensitivity. The files are re-scanned only when their modification
+time or size has changed. The index is stored in a SQLite database, typically in the footprints directory.
+"""
+
+import os
+import sqlite3
+import logging
+import h5py
+from contextlib import contextmanager
+from multiprocessing import Pool
+from numpy import unique, bincount, repeat, arange
+from pandas import read_sql_query
+from lumia import tqdm
+from .storage import is_consolidated
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ['filename', 'obs', 'nsteps', 'nnz', 'tmin', 'tmax', 'total']
+
+
+def scan_file(filename):
+    """
+    Read the metadata of all the footprints in a file. Returns a list of (filename, obs, nsteps, nnz, tmin, tmax,
+    total) tuples (tmin and tmax are YYYYmmddHHMMSS strings).
+    """
+    rows = []
+    with h5py.File(filename, 'r') as ds :
+        if is_consolidated(ds):
+            obs = [name.decode() for name in ds['obs'][:]]
+            offsets = ds['offsets'][:]
+            steps = [name.decode().split('_') for name in ds['steps'][:]]
+            istep = ds['istep'][:]
+            counts = offsets[1:]-offsets[:-1]
+            total = bincount(repeat(arange(len(obs)), counts), weights=ds['resp'][:], minlength=len(obs))
+            for iobs, name in enumerate(obs):
+                obs_steps = unique(istep[offsets[iobs]:offsets[iobs+1]])
+                if len(obs_steps) == 0 :
+                    rows.append((filename, name, 0, 0, None, None, 0.))
+                    continue
+                tmin = min(steps[i][1] for i in obs_steps)
+                tmax = max(steps[i][0] for i in obs_steps)
+                rows.append((filename, name, len(obs_steps), int(counts[iobs]), tmin, tmax, float(total[iobs])))
+        else :
+            for name in ds.keys():
+                if name in ['latitudes', 'longitudes'] : continue
+                nsteps, nnz, tmin, tmax, total = 0, 0, None, None, 0.
+                for tt in ds[name].keys():
+                    t1, t2 = tt.split('_')
+                    if t2 >= t1 : continue
+                    resp = ds[name][tt]['resp'][:]
+                    nsteps += 1
+                    nnz += len(resp)
+                    total += float(resp.sum())
+                    tmin = t2 if tmin is None else min(tmin, t2)
+                    tmax = t1 if tmax is None else max(tmax, t1)
+                rows.append((filename, name, nsteps, nnz, tmin, tmax, total))
+    return rows
+
+
+class FootprintIndex:
+    def __init__(self, filename):
+        self.filename = filename
+        with self.connect() as db :
+            db.execute('CREATE TABLE IF NOT EXISTS files (filename TEXT PRIMARY KEY, mtime REAL, size INTEGER)')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS footprints (filename TEXT, obs TEXT, nsteps INTEGER, nnz INTEGER, '
+                'tmin TEXT, tmax TEXT, total REAL, PRIMARY KEY (filename, obs))'
+            )
+
+    @contextmanager
+    def connect(self):
+        """
+        Open the database, commit the changes on exit (or roll them back in case of error), and close it
+        """
+        db = sqlite3.connect(self.filename)
+        try :
+            with db :
+                yield db
+        finally :
+            db.close()
+
+    def stale(self, files):
+        """
+        Return the files that are not in the index, or that have been modified since they were indexed
+        """
+        with self.connect() as db :
+            indexed = {f: (mtime, size) for (f, mtime, size) in db.execute('SELECT filename, mtime, size FROM files')}
+        stale = []
+        for file in files :
+            stat = os.stat(file)
+            if indexed.get(file) != (stat.st_mtime, stat.st_size):
+                stale.append(file)
+        return stale
+
+    def update(self, files, nproc=None):
+        """
+        (Re-)index the files that are new or have been modified. Files that don't exist are removed from the index.
+        The files are scanned in parallel, on "nproc" processes (by default, all the available CPUs).
+        """
+        missing = [f for f in files if not os.path.exists(f)]
+        stale = self.stale([f for f in files if os.path.exists(f)])
+        if len(stale) > 0 :
+            with Pool(nproc) as p :
+                scanned = list(tqdm(p.imap(scan_file, stale), total=len(stale), desc='Indexing footprint files', leave=False))
+        else :
+            scanned = []
+        with self.connect() as db :
+            for file in missing+stale :
+                db.execute('DELETE FROM footprints WHERE filename = ?', (file,))
+                db.execute('DELETE FROM files WHERE filename = ?', (file,))
+            for file, rows in zip(stale, scanned):
+                stat = os.stat(file)
+                db.executemany(f'INSERT INTO footprints ({", ".join(COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+                db.execute('INSERT INTO files (filename, mtime, size) VALUES (?, ?, ?)', (file, stat.st_mtime, stat.st_size))
+        logger.info(f"Footprint index {self.filename} updated ({len(stale)} files scanned, {len(missing)} missing)")
+
+    def select(self, files):
+        """
+        Return the index entries of the footprints in "files", as a DataFrame
+        """
+        with self.connect() as db :
+            db.execute('CREATE TEMP TABLE selection (filename TEXT PRIMARY KEY)')
+            db.executemany('INSERT OR IGNORE INTO selection VALUES (?)', [(f,) for f in files])
+            return read_sql_query(
+                f'SELECT {", ".join("footprints."+c for c in COLUMNS)} FROM footprints JOIN selection USING (filename)', db
+            )
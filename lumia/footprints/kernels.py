@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""
+Computational kernels of the Lagrangian transport: application of the footprints stored in one footprint file to an
+emission structure (forward) or to a vector of departures (adjoint). They are shared by the serial transport and by the
+transport workers.
+"""
+
+from numpy import zeros, stack, ma, nan, add, bincount, concatenate, repeat, diff, prod
+from .footprint import Footprint
+from .prefetch import prefetch
+
+
+def stack_emis(emis, categories):
+    """
+    Stack the emissions of the requested categories in a single (ncat, nt*nlat*nlon) array, as used by forward_block.
+    Masked values are converted to NaN.
+    """
+    return stack([ma.filled(emis[cat]['emis'], nan).reshape(-1) for cat in categories])
+
+
+def forward_block(block, E):
+    """
+    Apply the footprints of a FootprintBlock to the stacked emissions "E" (as returned by stack_emis, possibly for
+    several ensemble members), for all the rows of "E" at once. Returns the footprint totals of the valid observations
+    and their (nvalid x nrows) concentrations.
+    """
+    # Gather the emissions under each footprint element, multiply by the sensitivity and sum by observation.
+    # Empty segments are skipped, since add.reduceat doesn't handle them.
+    starts = block.offsets[:-1]
+    nonempty = starts < block.offsets[1:]
+    values = zeros((block.nobs, E.shape[0]))
+    totals = zeros(block.nobs)
+    if nonempty.any():
+        values[nonempty, :] = add.reduceat(E[:, block.index]*block.resp, starts[nonempty], axis=1).T
+        totals[nonempty] = add.reduceat(block.resp, starts[nonempty], dtype=float)
+    return totals[block.valid], values[block.valid, :]
+
+
+def read_block(fpfile, times, times_index, shape, cache=None):
+    """
+    Read the footprints of the observations at "times" from "fpfile", or retrieve them from "cache" (a
+    FootprintCache) if they have already been read.
+    """
+    def load():
+        fp = Footprint(fpfile)
+        block = fp.readBlock(times, times_index, shape)
+        fp.close()
+        return block
+    if cache is None :
+        return load()
+    return cache.get((fpfile, tuple(times)), load)
+
+
+def iter_blocks(task, times_index, shape, cache=None, depth=0):
+    """
+    Iterate over the footprint files of a task (list of (footprint file, observation ids, observation times) tuples,
+    see scheduler.partition), and yield (observation ids, FootprintBlock) pairs. The next "depth" files are read in
+    the background while the current one is being processed.
+    """
+    def load(item):
+        fpfile, fids, ftimes = item
+        return fids, read_block(fpfile, ftimes, times_index, shape, cache)
+    return prefetch(load, task, depth)
+
+
+class AdjointAccumulator:
+    """
+    Accumulate the adjoint of footprint blocks in a flat (nt*nlat*nlon) field. The flat indices and weights of the
+    footprint elements are buffered, and summed into the field with a single bincount once the buffer exceeds
+    "buffer_size" elements (by default, a quarter of the field size), which also handles duplicated indices.
+    If an "out" array is provided (e.g. a shared memory slab), the adjoint is accumulated directly in it.
+    With "nmembers", the adjoint of "nmembers" departure vectors is computed at once (the departures passed to "add"
+    are then (nobs x nmembers) arrays).
+    """
+    def __init__(self, shape, buffer_size=None, out=None, nmembers=None):
+        self.shape = shape
+        self.size = int(prod(shape))
+        self.nmembers = nmembers
+        fshape = self.size if nmembers is None else (nmembers, self.size)
+        self.field = zeros(fshape) if out is None else out.reshape(fshape)
+        self.buffer_size = max(self.size//4, 1) if buffer_size is None else buffer_size
+        self.index, self.weights = [], []
+        self.buffered = 0
+
+    def add(self, block, dy):
+        """
+        Add the adjoint of a FootprintBlock for the departures "dy" (one value per observation of the block)
+        """
+        self.index.append(block.index)
+        dy = repeat(dy, diff(block.offsets), axis=0)
+        self.weights.append(dy*block.resp if self.nmembers is None else dy*block.resp[:, None])
+        self.buffered += len(block.index)
+        if self.buffered >= self.buffer_size :
+            self.flush()
+
+    def flush(self):
+        if self.buffered > 0 and self.nmembers is None :
+            self.field += bincount(concatenate(self.index), weights=concatenate(self.weights), minlength=self.size)
+        elif self.buffered > 0 :
+            index, weights = concatenate(self.index), concatenate(self.weights)
+            for imember in range(self.nmembers):
+                self.field[imember] += bincount(index, weights=weights[:, imember], minlength=self.size)
+        self.index, self.weights = [], []
+        self.buffered = 0
+
+    def result(self):
+        """
+        Returns the adjoint field, as a (nt, nlat, nlon) array (or (nmembers, nt, nlat, nlon))
+        """
+        self.flush()
+        return self.field.reshape(self.shape if self.nmembers is None else (self.nmembers,) + tuple(self.shape))
+
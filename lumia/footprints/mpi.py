@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+"""
+MPI backend of the transport: the footprint files are distributed over the ranks of an MPI communicator (possibly on
+several nodes). Rank 0 drives the transport (MPIFootprintPool, which has the same interface as FootprintPool), and the
+other ranks wait for its instructions in "serve". Each rank keeps its footprints (and its footprint cache) in memory
+between the transport runs of a same process: for the ranks to stay alive through a whole inversion, the model must be
+started as a transport server (e.g. "mpirun -n 4 python lagrange_mp.py --mpi --serve ...", which is what
+lumia.obsoperator does with the model.transport.mpi rc-key). A one-shot run ("--forward" or "--adjoint" instead of
+"--serve") starts and stops the ranks.
+"""
+
+import logging
+from mpi4py import MPI
+from numpy import concatenate, empty, zeros_like, ascontiguousarray, float64
+from .scheduler import partition
+from .cache import FootprintCache
+from .pool import run_forward, run_adjoint
+
+logger = logging.getLogger(__name__)
+
+
+class MPIRank:
+    """
+    Transport state of one MPI rank (the footprint files it has been assigned, and its cache), and collective
+    operations, to be called simultaneously by all the ranks of the communicator.
+    """
+    def __init__(self, comm, task, times_index, shape, cache_size=None, compression=None, depth=0):
+        self.comm = comm
+        self.task = task
+        self.times_index = times_index
+        self.shape = shape
+        self.depth = depth
+        self.cache = FootprintCache(cache_size, compression) if cache_size else None
+
+    @property
+    def root(self):
+        return self.comm.Get_rank() == 0
+
+    def forward(self, E=None):
+        """
+        Broadcast the stacked emissions "E" (only needed on rank 0), and gather the results of all the ranks on rank 0.
+        The emissions are sent as a contiguous float64 array (whatever their dtype on rank 0).
+        """
+        if self.root :
+            E = ascontiguousarray(E, dtype=float64)
+        shape = self.comm.bcast(E.shape if self.root else None, root=0)
+        if not self.root :
+            E = empty(shape, dtype=float64)
+        self.comm.Bcast([E, MPI.DOUBLE], root=0)
+        result = run_forward(self.task, E, self.times_index, self.shape, self.cache, self.depth)
+        return self.comm.gather(result, root=0)
+
+    def adjoint(self, dys=None):
+        """
+        Scatter the departures (list of pandas Series, one per rank, only needed on rank 0), and reduce the adjoint
+        fields of all the ranks on rank 0.
+        """
+        dy = self.comm.scatter(dys, root=0)
+        field = ascontiguousarray(run_adjoint(self.task, dy, self.times_index, self.shape, self.cache, self.depth), dtype=float64)
+        total = zeros_like(field) if self.root else None
+        self.comm.Reduce([field, MPI.DOUBLE], [total, MPI.DOUBLE] if self.root else None, op=MPI.SUM, root=0)
+        return total
+
+    def stats(self):
+        return self.comm.gather(None if self.cache is None else self.cache.stats(), root=0)
+
+
+class MPIFootprintPool:
+    """
+    Distribute the transport over the ranks of an MPI communicator. Must be created on rank 0, while all the other
+    ranks are in "serve". Rank 0 takes its share of the footprint files as well.
+    """
+    def __init__(self, observations, times_index, shape, comm=None, cache_size=None, compression=None, prefetch=0):
+        self.comm = MPI.COMM_WORLD if comm is None else comm
+        tasks = partition(observations, self.comm.Get_size())
+        tasks += [[] for _ in range(self.comm.Get_size()-len(tasks))]
+        self.ids = [concatenate([fids for (fpfile, fids, ftimes) in task]) if len(task) > 0 else [] for task in tasks]
+        setup = (times_index, shape, cache_size, compression, prefetch)
+        self.comm.bcast(setup, root=0)
+        task = self.comm.scatter(tasks, root=0)
+        self.rank = MPIRank(self.comm, task, *setup)
+        logger.info(f"MPI transport started on {self.comm.Get_size()} ranks")
+
+    def forward(self, E):
+        """
+        Apply the footprints to the stacked emissions "E" (see kernels.stack_emis). Returns the ids of the observations
+        with a valid footprint, their footprint totals and their (nobs x nrows) concentrations.
+        """
+        self.comm.bcast('forward', root=0)
+        results = self.rank.forward(E)
+        ids, totals, values = zip(*results)
+        return concatenate(ids), concatenate(totals), concatenate(values)
+
+    def adjoint(self, dy):
+        """
+        Returns the adjoint field, summed over all the ranks. "dy" is a pandas Series, indexed by observation id, or a
+        DataFrame with one column per ensemble member.
+        """
+        self.comm.bcast('adjoint', root=0)
+        return self.rank.adjoint([dy.loc[ids] for ids in self.ids])
+
+    def cacheStats(self):
+        """
+        Return the footprint cache statistics, summed over all the ranks (or None if the ranks have no cache)
+        """
+        self.comm.bcast('stats', root=0)
+        stats = [s for s in self.rank.stats() if s is not None]
+        if len(stats) == 0 :
+            return None
+        return {k: sum(s[k] for s in stats) for k in stats[0]}
+
+    def close(self):
+        self.comm.bcast('stop', root=0)
+
+
+def serve(comm=None):
+    """
+    Main loop of the ranks other than rank 0: wait for the setup of an MPIFootprintPool, and then for instructions,
+    until rank 0 closes the pool (or calls "shutdown" without ever creating it).
+    """
+    comm = MPI.COMM_WORLD if comm is None else comm
+    setup = comm.bcast(None, root=0)
+    if setup is None :
+        return
+    rank = MPIRank(comm, comm.scatter(None, root=0), *setup)
+    logger.debug(f"Rank {comm.Get_rank()} ready, with {len(rank.task)} footprint files")
+    while True :
+        cmd = comm.bcast(None, root=0)
+        if cmd == 'stop' :
+            break
+        getattr(rank, cmd)()
+
+
+def shutdown(comm=None):
+    """
+    Release the ranks waiting in "serve", if no MPIFootprintPool has been created (called from rank 0).
+    """
+    comm = MPI.COMM_WORLD if comm is None else comm
+    comm.bcast(None, root=0)
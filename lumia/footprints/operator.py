@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+import os
+import logging
+from numpy import array, asarray, concatenate, full, load, savez, array_equal, unique
+from scipy.sparse import csr_matrix, coo_matrix
+from lumia import tqdm
+from .footprint import Footprint, timesIndex
+
+logger = logging.getLogger(__name__)
+
+
+def obsKeys(footprints, times):
+    """
+    Build the keys identifying the observations in a SparseOperator (footprint file name and observation time).
+    "footprints" and "times" are pandas Series (e.g. columns of obsdb.observations).
+    """
+    return footprints.astype(object).map(os.path.basename) + ':' + times.dt.strftime('%Y%m%d%H%M%S')
+
+
+class SparseOperator:
+    """
+    Precompiled observation operator of the Lagrangian transport model: a sparse (nobs x nt*nlat*nlon) matrix "H", such
+    that the foreground concentrations are H @ emis.ravel(), and the adjoint H.T @ dy.
+
+    The rows are identified by keys of the form "<footprint file name>:<observation time (YYYYmmddHHMMSS)>", so that the
+    operator remains valid when the observation database is reindexed or split, or when the footprints are moved to a
+    cache directory. Observations without (valid) footprint have no row in the operator.
+    """
+    def __init__(self, H, keys, times_start, times_end, shape):
+        self.H = csr_matrix(H)
+        self.keys = asarray(keys)
+        self.times_start = asarray(times_start, dtype='datetime64[s]')
+        self.times_end = asarray(times_end, dtype='datetime64[s]')
+        self.shape = tuple(shape)
+        self.totals = asarray(self.H.sum(axis=1)).ravel()
+
+    @classmethod
+    def build(cls, observations, times_start, times_end, nlat, nlon, disable_pbar=False):
+        """
+        Compile the footprints of all the observations in "observations" (a obsdb.observations dataframe, with at least
+        "time" and "footprint" columns) into a sparse operator, on the emission grid defined by the time intervals
+        (times_start, times_end) and by the number of latitudes and longitudes.
+        """
+        nt = len(times_start)
+        times_index = timesIndex(times_start, times_end)
+
+        rows, cols, resp, keys = [], [], [], []
+        files = unique(observations.footprint.dropna())
+        for fpfile in tqdm(files, total=len(files), desc='Build observation operator', leave=False, disable=disable_pbar):
+            fp = Footprint(fpfile)
+            for time in observations.loc[observations.footprint == fpfile, 'time']:
+                data = fp.readObs(time, times_index)
+                if data is None : continue
+                itimes, ilats, ilons, values = data
+                rows.append(full(len(values), len(keys)))
+                cols.append((itimes*nlat+ilats)*nlon+ilons)
+                resp.append(values)
+                keys.append(f"{os.path.basename(fpfile)}:{time.strftime('%Y%m%d%H%M%S')}")
+            fp.close()
+
+        if len(keys) == 0 :
+            logger.warning("No valid footprint found, the observation operator is empty")
+            H = csr_matrix((0, nt*nlat*nlon))
+        else :
+            # The conversion to CSR sums the eventual duplicated elements
+            H = coo_matrix((concatenate(resp), (concatenate(rows), concatenate(cols))), shape=(len(keys), nt*nlat*nlon)).tocsr()
+        logger.info(f"Observation operator built for {len(keys)} observations ({H.nnz} non-zero elements)")
+        return cls(H, keys, times_start, times_end, (nt, nlat, nlon))
+
+    def save(self, filename):
+        savez(
+            filename, data=self.H.data, indices=self.H.indices, indptr=self.H.indptr, nrows=self.H.shape[0],
+            keys=self.keys, times_start=self.times_start, times_end=self.times_end, shape=array(self.shape)
+        )
+        logger.info(f"Observation operator written to {filename}")
+        return filename
+
+    @classmethod
+    def load(cls, filename):
+        with load(filename) as ds :
+            shape = tuple(ds['shape'])
+            H = csr_matrix((ds['data'], ds['indices'], ds['indptr']), shape=(int(ds['nrows']), shape[0]*shape[1]*shape[2]))
+            op = cls(H, ds['keys'], ds['times_start'], ds['times_end'], shape)
+        logger.info(f"Observation operator read from {filename}")
+        return op
+
+    def conforms(self, times_start, times_end, nlat, nlon):
+        """
+        Check that the operator has been built for the emission grid defined by the arguments
+        """
+        return (
+            self.shape[1:] == (nlat, nlon) and
+            array_equal(self.times_start, asarray(times_start, dtype='datetime64[s]')) and
+            array_equal(self.times_end, asarray(times_end, dtype='datetime64[s]'))
+        )
+
+    def restrict(self, observations):
+        """
+        Keep only the rows corresponding to the observations in "observations", in the order of the dataframe.
+        Returns the index of the observations that are covered by the operator.
+        """
+        obs = observations.loc[observations.footprint.notna()]
+        rows = obsKeys(obs.footprint, obs.time).map({k: i for (i, k) in enumerate(self.keys)})
+        valid = rows.notna().values
+        if not valid.all() :
+            logger.warning(f"{(~valid).sum()} observations with a footprint file are not covered by the observation operator (missing or invalid footprints?)")
+        rows = rows.values[valid].astype(int)
+        self.H = self.H[rows]
+        self.keys = self.keys[rows]
+        self.totals = self.totals[rows]
+        return obs.index[valid]
+
+    def apply(self, E):
+        """
+        Apply the operator to stacked emissions "E" ((nrows x nt*nlat*nlon) array, see kernels.stack_emis). Returns a
+        (nobs x nrows) array.
+        """
+        return self.H @ asarray(E).T
+
+    def adjoint(self, dy):
+        """
+        Compute the adjoint field (nt x nlat x nlon) of the "dy" departures (one value per row of the operator).
+        If "dy" is a (nobs x nmembers) array, returns a (nmembers x nt x nlat x nlon) array.
+        """
+        dy = asarray(dy)
+        adj = self.H.T @ dy
+        if dy.ndim == 2 :
+            return adj.T.reshape((dy.shape[1],) + tuple(self.shape))
+        return adj.reshape(self.shape)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+import logging
+import traceback
+from multiprocessing import get_context, resource_tracker
+from numpy import concatenate, zeros
+from .scheduler import partition
+from .cache import FootprintCache
+from .kernels import iter_blocks, forward_block, AdjointAccumulator
+from .shm import SharedArray
+
+logger = logging.getLogger(__name__)
+
+
+def run_forward(task, E, times_index, shape, cache=None, depth=0):
+    """
+    Forward run over all the footprint files of a task, for the stacked emissions "E" (see kernels.stack_emis).
+    Returns the ids of the observations with a valid footprint, their footprint totals and their (nobs x ncat)
+    concentrations.
+    """
+    ids, totals, values = [], [], []
+    for fids, block in iter_blocks(task, times_index, shape, cache, depth):
+        tot, val = forward_block(block, E)
+        ids.append(fids[block.valid])
+        totals.append(tot)
+        values.append(val)
+    if len(ids) == 0 :
+        return zeros(0, dtype=int), zeros(0), zeros((0, E.shape[0]))
+    return concatenate(ids), concatenate(totals), concatenate(values)
+
+
+def run_adjoint(task, dy, times_index, shape, cache=None, depth=0, out=None):
+    """
+    Adjoint run over all the footprint files of a task. "dy" is a pandas Series with the departures, indexed by
+    observation id (or a DataFrame, with one column per ensemble member). Returns the adjoint field, as a
+    (nt x nlat x nlon) array, or (nmembers x nt x nlat x nlon), accumulated in "out" if provided.
+    """
+    acc = AdjointAccumulator(shape, out=out, nmembers=dy.shape[1] if dy.ndim == 2 else None)
+    for fids, block in iter_blocks(task, times_index, shape, cache, depth):
+        acc.add(block, dy.loc[fids].values)
+    return acc.result()
+
+
+def worker(conn, task, times_index, shape, cache_size=None, compression=None, depth=0):
+    """
+    Main loop of the transport workers: wait for instructions from the parent process, and send back the results.
+    If "cache_size" is set, the worker keeps up to that amount of footprints (in bytes) in memory between calls.
+    The next "depth" footprint files are read in the background while the current one is being processed.
+    The emissions are read from, and the adjoint written to, shared memory buffers allocated by the parent process.
+    """
+    cache = FootprintCache(cache_size, compression) if cache_size else None
+    buffers = {}
+
+    def attach(spec):
+        name = spec[0]
+        if name not in buffers :
+            buffers[name] = SharedArray.attach(spec)
+        return buffers[name].array
+
+    while True :
+        cmd, args = conn.recv()
+        if cmd == 'stop' :
+            break
+        try :
+            if cmd == 'forward' :
+                result = run_forward(task, attach(args), times_index, shape, cache, depth)
+            elif cmd == 'stats' :
+                result = None if cache is None else cache.stats()
+            elif cmd == 'adjoint' :
+                spec, rank, dy = args
+                slab = attach(spec)[rank]
+                slab[:] = 0.
+                run_adjoint(task, dy, times_index, shape, cache, depth, out=slab)
+                result = None
+            elif cmd == 'release' :
+                # The parent process is about to free a shared buffer
+                if args in buffers :
+                    buffers.pop(args).close()
+                result = None
+            conn.send(('ok', result))
+        except Exception :
+            conn.send(('error', traceback.format_exc()))
+    for buf in buffers.values():
+        buf.close()
+    conn.close()
+
+
+def tree_reduce(slabs):
+    """
+    Sum the slabs (first dimension of the array) pairwise, in place, in log2(nslabs) vectorized steps.
+    Returns the sum (a view of the first slab).
+    """
+    n = slabs.shape[0]
+    while n > 1 :
+        half = (n+1)//2
+        slabs[:n-half] += slabs[half:n]
+        n = half
+    return slabs[0]
+
+
+class FootprintPool:
+    """
+    Pool of long-lived transport worker processes. Each worker is assigned a fixed set of footprint files when the pool
+    is created, and then only receives the emissions (forward) or the departures (adjoint) at each call. The results
+    are exchanged through shared memory: the stacked emissions are written once in a buffer that all the workers read,
+    and each worker accumulates its adjoint in its own slab of a shared array, which the parent then tree-reduces.
+    Each worker can keep its footprints in a FootprintCache of "cache_size" bytes, and reads the
+    next "prefetch" footprint files in the background while processing the current one.
+    """
+    def __init__(self, observations, times_index, shape, nworkers, cache_size=None, compression=None, prefetch=0):
+        ctx = get_context('fork')
+        # Start the shared memory tracker before forking, so that the workers share it with the parent process
+        resource_tracker.ensure_running()
+        self.workers = []
+        self.ids = []
+        for task in partition(observations, nworkers):
+            conn, child = ctx.Pipe()
+            proc = ctx.Process(target=worker, args=(child, task, times_index, shape, cache_size, compression, prefetch), daemon=True)
+            proc.start()
+            child.close()
+            self.workers.append((proc, conn))
+            self.ids.append(concatenate([fids for (fpfile, fids, ftimes) in task]) if len(task) > 0 else [])
+        self.emis_buffer = None
+        self.adj_buffer = None
+        self.shape = shape
+        logger.info(f"Transport pool started with {len(self.workers)} workers")
+
+    def run(self, cmd, args):
+        """
+        Send a command to all the workers and collect the results. "args" is a list with the arguments for each worker.
+        """
+        for (proc, conn), wargs in zip(self.workers, args) :
+            conn.send((cmd, wargs))
+        results = []
+        for proc, conn in self.workers :
+            try :
+                status, result = conn.recv()
+            except EOFError :
+                logger.error(f"Transport worker {proc.pid} died unexpectedly")
+                raise RuntimeError
+            if status == 'error' :
+                logger.error(f"Transport worker {proc.pid} failed with:\n{result}")
+                raise RuntimeError
+            results.append(result)
+        return results
+
+    def forward(self, E):
+        """
+        Apply the footprints to the stacked emissions "E" (see kernels.stack_emis). Returns the ids of the observations
+        with a valid footprint, their footprint totals and their (nobs x nrows) concentrations.
+        """
+        if self.emis_buffer is None or not self.emis_buffer.conforms(E.shape, E.dtype):
+            self.release('emis_buffer')
+            self.emis_buffer = SharedArray(E.shape, E.dtype)
+        self.emis_buffer.array[:] = E
+        results = self.run('forward', [self.emis_buffer.spec]*len(self.workers))
+        ids, totals, values = zip(*results)
+        return concatenate(ids), concatenate(totals), concatenate(values)
+
+    def adjoint(self, dy):
+        """
+        Returns the adjoint field, summed over all the workers. "dy" is a pandas Series, indexed by observation id, or a
+        DataFrame with one column per ensemble member.
+        """
+        shape = (len(self.workers),) + dy.shape[1:] + tuple(self.shape)
+        if self.adj_buffer is None or not self.adj_buffer.conforms(shape):
+            self.release('adj_buffer')
+            self.adj_buffer = SharedArray(shape)
+        spec = self.adj_buffer.spec
+        self.run('adjoint', [(spec, rank, dy.loc[ids]) for rank, ids in enumerate(self.ids)])
+        return tree_reduce(self.adj_buffer.array).copy()
+
+    def release(self, attr):
+        """
+        Free one of the shared memory buffers of the pool (self.emis_buffer or self.adj_buffer), after making sure
+        that the workers have detached from it.
+        """
+        buf = getattr(self, attr)
+        if buf is None :
+            return
+        if len(self.workers) > 0 and all(proc.is_alive() for proc, conn in self.workers):
+            self.run('release', [buf.shm.name]*len(self.workers))
+        buf.close()
+        setattr(self, attr, None)
+
+    def cacheStats(self):
+        """
+        Return the footprint cache statistics, summed over all the workers (or None if the workers have no cache)
+        """
+        stats = [s for s in self.run('stats', [None]*len(self.workers)) if s is not None]
+        if len(stats) == 0 :
+            return None
+        return {k: sum(s[k] for s in stats) for k in stats[0]}
+
+    def close(self):
+        self.release('emis_buffer')
+        self.release('adj_buffer')
+        for proc, conn in self.workers :
+            # The workers may already have been terminated (e.g. at interpreter exit)
+            if proc.is_alive():
+                conn.send(('stop', None))
+            conn.close()
+        for proc, conn in self.workers :
+            proc.join()
+        self.workers = []
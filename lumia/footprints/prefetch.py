@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def prefetch(func, items, depth=1):
+    """
+    Iterate over func(item) for all the items, while computing the results for up to "depth" next items in a
+    background thread. This is meant to overlap the reading of the next footprint files with the computations on the
+    current one (the HDF5 reads wait on the file system, during which the main thread can keep computing).
+    The items are processed in order, by a single thread, so "func" doesn't need to be thread-safe with itself.
+    With depth=0, no background thread is used.
+    """
+    if depth < 1 :
+        for item in items :
+            yield func(item)
+        return
+
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=1) as executor :
+        pending = deque()
+        for item in items :
+            pending.append(executor.submit(func, item))
+            if len(pending) > depth :
+                break
+        while pending :
+            result = pending.popleft().result()
+            for item in items :
+                pending.append(executor.submit(func, item))
+                break
+            yield result
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""
+Distribution of the footprint files among the transport workers.
+"""
+
+import os
+import heapq
+import logging
+from numpy import argsort
+
+logger = logging.getLogger(__name__)
+
+# Size on disk of one footprint element (int32 lat and lon indices and float32 sensitivity), used to estimate the
+# number of footprint elements in a file from its size
+BYTES_PER_ELEMENT = 12
+
+
+def available_cpus():
+    """
+    Number of CPUs available to the current process
+    """
+    try :
+        return len(os.sched_getaffinity(0))
+    except AttributeError :
+        return os.cpu_count()
+
+
+def estimate_cost(fpfile, nobs, nelements=None):
+    """
+    Estimate the cost of processing a footprint file, as its number of observations (overhead of accessing each
+    footprint) plus its number of footprint elements (gather/scatter operations). When the number of elements is not
+    known, it is estimated from the size of the file.
+    """
+    if nelements is None :
+        nelements = os.path.getsize(fpfile)/BYTES_PER_ELEMENT if os.path.exists(fpfile) else 0
+    return nobs + nelements
+
+
+def balance(costs, nchunks):
+    """
+    Assign items to "nchunks" chunks, using the longest-processing-time rule: the items are sorted by decreasing cost,
+    and each one is assigned to the chunk with the lowest total cost so far.
+    Returns a list of lists of item positions, and the total cost of each chunk.
+    """
+    chunks = [[] for _ in range(nchunks)]
+    loads = [(0., ichunk) for ichunk in range(nchunks)]
+    for item in argsort(costs)[::-1]:
+        load, ichunk = heapq.heappop(loads)
+        chunks[ichunk].append(item)
+        heapq.heappush(loads, (load+costs[item], ichunk))
+    return chunks, [load for (load, ichunk) in sorted(loads, key=lambda x: x[1])]
+
+
+def partition(observations, nchunks=None, costs=None):
+    """
+    Distribute the observations of a obsdb.observations dataframe (with at least "time" and "footprint" columns) in
+    "nchunks" tasks of similar cost (by default, one per available CPU). Observations from a same footprint file are
+    always in the same task, so that each file is read by only one worker.
+    The cost of each file can be provided as a {filename: cost} dictionary, otherwise it is estimated with
+    estimate_cost (using the "footprint_nnz" column, if present).
+    Each task is a list of (footprint file, observation ids, observation times) tuples.
+    """
+    obs = observations.loc[observations.footprint.notna(), ['time', 'footprint']]
+    groups = obs.groupby('footprint', observed=True)
+    files = list(groups.groups.keys())
+    if nchunks is None :
+        nchunks = available_cpus()
+    nchunks = max(min(nchunks, len(files)), 1)
+
+    if costs is None and 'footprint_nnz' in observations.columns :
+        # Exact number of footprint elements, if the footprints have been checked with a FootprintIndex
+        nnz = observations.loc[obs.index].groupby('footprint', observed=True).footprint_nnz.sum()
+        costs = {fpfile: estimate_cost(fpfile, len(groups.groups[fpfile]), nnz[fpfile]) for fpfile in files}
+    elif costs is None :
+        costs = {fpfile: estimate_cost(fpfile, len(groups.groups[fpfile])) for fpfile in files}
+    chunks, loads = balance([costs[fpfile] for fpfile in files], nchunks)
+    if len(files) > 0 :
+        logger.debug(f"Footprint files distributed in {nchunks} tasks, cost imbalance (max/mean): {max(loads)*nchunks/sum(loads):.2f}")
+
+    tasks = []
+    for chunk in chunks :
+        task = []
+        for ifile in sorted(chunk):
+            fpfile = files[ifile]
+            group = groups.get_group(fpfile)
+            task.append((fpfile, group.index.values, group.time.tolist()))
+        tasks.append(task)
+    return tasks
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+from multiprocessing.shared_memory import SharedMemory
+from numpy import ndarray, dtype as npdtype, prod
+
+
+class SharedArray:
+    """
+    numpy array stored in a shared memory segment, so that it can be accessed by several processes without copy.
+    The array is created by the parent process (SharedArray(shape)), and the worker processes attach to it using its
+    "spec" (SharedArray.attach(spec)). Only the process that created the array should unlink it.
+    """
+    def __init__(self, shape, dtype='float64', name=None):
+        self.shape = tuple(shape)
+        self.dtype = npdtype(dtype)
+        nbytes = max(int(prod(self.shape))*self.dtype.itemsize, 1)
+        self.owner = name is None
+        self.shm = SharedMemory(create=True, size=nbytes) if self.owner else SharedMemory(name=name)
+        self.array = ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    @property
+    def spec(self):
+        """
+        Picklable description of the array, to be sent to the processes that need to attach to it.
+        """
+        return self.shm.name, self.shape, self.dtype.str
+
+    @classmethod
+    def attach(cls, spec):
+        name, shape, dtype = spec
+        return cls(shape, dtype, name=name)
+
+    def conforms(self, shape, dtype='float64'):
+        return self.shape == tuple(shape) and self.dtype == npdtype(dtype)
+
+    def close(self):
+        """
+        Detach from the shared memory segment (and destroy it, if this is the process that created it).
+        """
+        del self.array
+        self.shm.close()
+        if self.owner :
+            self.shm.unlink()
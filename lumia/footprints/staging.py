@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""
+Staging of the footprint files to a local cache directory (e.g. node-local scratch).
+
+The files are copied concurrently, by a bounded number of threads (the copies are I/O bound). A manifest, stored in the
+cache directory, records the size and modification time of the source of each staged file, and the size and checksum
+of the copy, so that later runs only copy the files that are missing from the cache or that have changed since. The
+checksum of the staged copies is verified when they are reused, and the corrupted copies are replaced.
+"""
+
+import os
+import json
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from lumia import tqdm
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'footprints.manifest.json'
+BUFFER_SIZE = 16*1024*1024
+
+
+def copy_file(src, dest):
+    """
+    Copy "src" to "dest" (following symbolic links), through a temporary file, and return the sha1 checksum of the
+    data copied
+    """
+    checksum = hashlib.sha1()
+    tmp = f'{dest}.{os.getpid()}.tmp'
+    with open(src, 'rb') as fin, open(tmp, 'wb') as fout :
+        while True :
+            data = fin.read(BUFFER_SIZE)
+            if not data :
+                break
+            checksum.update(data)
+            fout.write(data)
+    os.replace(tmp, dest)
+    return checksum.hexdigest()
+
+
+def file_checksum(filename):
+    """
+    sha1 checksum of a file
+    """
+    checksum = hashlib.sha1()
+    with open(filename, 'rb') as fid :
+        for data in iter(lambda: fid.read(BUFFER_SIZE), b''):
+            checksum.update(data)
+    return checksum.hexdigest()
+
+
+class FootprintStager:
+    """
+    Copy footprint files from the "source" directory to the "cache" directory, keeping the same relative paths.
+    With "verify" (the default), the checksum of the files already in the cache is checked before they are reused.
+    """
+    def __init__(self, source, cache, nworkers=8, verify=True):
+        self.source = source
+        self.cache = cache
+        self.nworkers = nworkers
+        self.verify = verify
+        self.manifest_file = os.path.join(cache, MANIFEST)
+        self.manifest = {}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r') as fid :
+                self.manifest = json.load(fid)
+
+    def cachePath(self, filename):
+        return os.path.join(self.cache, os.path.relpath(filename, self.source))
+
+    def save(self):
+        tmp = f'{self.manifest_file}.tmp'
+        with open(tmp, 'w') as fid :
+            json.dump(self.manifest, fid)
+        os.replace(tmp, self.manifest_file)
+
+    def stageFile(self, file):
+        """
+        Copy a file to the cache, unless it is already there and unchanged. Returns the status of the file ('staged',
+        'copied' or 'missing') and its (new) manifest entry.
+        """
+        dest = self.cachePath(file)
+        entry = self.manifest.get(file)
+        cached = os.stat(dest) if os.path.exists(dest) else None
+        if not os.path.exists(file):
+            return ('missing', None) if cached is None else ('staged', entry)
+        stat = os.stat(file)
+        new = {'mtime': stat.st_mtime, 'size': stat.st_size}
+        if cached is not None and entry is None and cached.st_size == stat.st_size :
+            # File staged before the manifest was introduced
+            new['sha1'] = file_checksum(dest)
+            return 'staged', new
+        if cached is not None and entry is not None and (entry['mtime'], entry['size']) == (stat.st_mtime, stat.st_size) and cached.st_size == entry['size'] :
+            if not self.verify or file_checksum(dest) == entry['sha1'] :
+                return 'staged', entry
+            logger.warning(f"The staged copy of {file} doesn't match its checksum, it is copied again")
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        new['sha1'] = copy_file(file, dest)
+        return 'copied', new
+
+    def stage(self, files):
+        """
+        Make sure that all the "files" are in the cache (on "nworkers" threads). Returns a {file: path in cache}
+        dictionary (the path is None for the files that couldn't be found).
+        """
+        paths = {}
+        status = {'staged': 0, 'copied': 0, 'missing': 0}
+        try :
+            with ThreadPoolExecutor(max_workers=self.nworkers) as executor :
+                futures = {executor.submit(self.stageFile, file): file for file in files}
+                for future in tqdm(as_completed(futures), total=len(futures), desc='Staging footprint files', leave=False):
+                    file = futures[future]
+                    result, entry = future.result()
+                    status[result] += 1
+                    if result == 'missing' :
+                        logger.warning('File %s not found! no footprints will be read from it', file)
+                        paths[file] = None
+                    else :
+                        paths[file] = self.cachePath(file)
+                    if entry is not None :
+                        self.manifest[file] = entry
+        finally :
+            self.save()
+        logger.info(f"Footprint files staged in {self.cache}: {status['copied']} copied, {status['staged']} up to date, {status['missing']} missing")
+        return paths
+
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+"""
+Consolidated footprint storage format.
+
+The original footprint files contain one HDF5 group per observation and one sub-group per time step, each with its own
+ilats/ilons/resp datasets, which makes reading them dominated by the HDF5 metadata overhead. In the consolidated
+format, all the footprints of a file are stored in a few contiguous datasets:
+- ilat, ilon, resp : latitude and longitude indices and sensitivity of each footprint element
+- istep : index of the time step of each element, in the "steps" table
+- steps : names of the footprint time steps (YYYYmmddHHMMSS_YYYYmmddHHMMSS, end of the interval first, as in the group
+  names of the original format)
+- obs : observation times (YYYYmmddHHMMSS, i.e. the names of the observation groups in the original format), sorted
+- offsets : the elements of the i-th observation are in the [offsets[i]:offsets[i+1]] slice of the element datasets
+The "latitudes" and "longitudes" datasets are copied unchanged.
+
+Files can be converted with:
+    python -m lumia.footprints.storage file1.h5 file2.h5 ... --dest path/to/converted/files
+"""
+
+import os
+import sys
+import logging
+import h5py
+from argparse import ArgumentParser
+from numpy import array, arange, concatenate, zeros, int32, int64, float32, full, repeat, bincount
+from lumia import tqdm
+
+logger = logging.getLogger(__name__)
+
+FORMAT = 'lumia-consolidated'
+VERSION = 1
+
+
+def is_consolidated(ds):
+    """
+    Check if an open h5py.File is in the consolidated format
+    """
+    return ds.attrs.get('format', None) == FORMAT
+
+
+def convert(src, dest, compression=None):
+    """
+    Convert the footprint file "src" (original, one group per observation, format) to the consolidated format, in the
+    file "dest". Time steps named as tmin_tmax (old and wrong) are discarded, as they are when reading the original
+    files.
+    """
+    steps = {}
+    obs_names, counts, istep, ilat, ilon, resp = [], [], [], [], [], []
+    with h5py.File(src, 'r') as ds :
+        for obsname in sorted(k for k in ds.keys() if k not in ['latitudes', 'longitudes']):
+            nelem = 0
+            for tt in sorted(ds[obsname].keys()):
+                t1, t2 = tt.split('_')
+                if t2 >= t1 :
+                    continue
+                group = ds[obsname][tt]
+                try :
+                    ila, ilo = group['ilats'][:], group['ilons'][:]
+                except KeyError :
+                    ila, ilo = group['ilat'][:], group['ilon'][:]
+                if tt not in steps :
+                    steps[tt] = len(steps)
+                istep.append(full(len(ila), steps[tt], dtype=int32))
+                ilat.append(ila.astype(int32))
+                ilon.append(ilo.astype(int32))
+                resp.append(group['resp'][:].astype(float32))
+                nelem += len(ila)
+            obs_names.append(obsname)
+            counts.append(nelem)
+        latitudes = ds['latitudes'][:] if 'latitudes' in ds else None
+        longitudes = ds['longitudes'][:] if 'longitudes' in ds else None
+
+    def cat(arrays, dtype):
+        return concatenate(arrays).astype(dtype) if len(arrays) > 0 else zeros(0, dtype=dtype)
+
+    with h5py.File(dest, 'w') as ds :
+        ds.attrs['format'] = FORMAT
+        ds.attrs['version'] = VERSION
+        ds.attrs['source'] = os.path.basename(src)
+        ds['obs'] = array(obs_names, dtype='S14')
+        ds['offsets'] = concatenate(([0], array(counts, dtype=int64).cumsum()))
+        ds['steps'] = array(sorted(steps, key=steps.get), dtype='S29')
+        ds.create_dataset('istep', data=cat(istep, int32), compression=compression)
+        ds.create_dataset('ilat', data=cat(ilat, int32), compression=compression)
+        ds.create_dataset('ilon', data=cat(ilon, int32), compression=compression)
+        ds.create_dataset('resp', data=cat(resp, float32), compression=compression)
+        if latitudes is not None : ds['latitudes'] = latitudes
+        if longitudes is not None : ds['longitudes'] = longitudes
+    logger.debug(f"{len(obs_names)} footprints converted from {src} to {dest}")
+    return dest
+
+
+class ConsolidatedStore:
+    """
+    Reader for the footprint files in consolidated format (see the module documentation)
+    """
+    def __init__(self, ds):
+        self.ds = ds
+        self.obs = {name.decode(): iobs for (iobs, name) in enumerate(ds['obs'][:])}
+        self.offsets = ds['offsets'][:]
+        self.steps = [name.decode() for name in ds['steps'][:]]
+
+    def __contains__(self, obsname):
+        """
+        Check if the file contains a non-empty footprint for the observation "obsname" (YYYYmmddHHMMSS)
+        """
+        iobs = self.obs.get(obsname)
+        return iobs is not None and self.offsets[iobs+1] > self.offsets[iobs]
+
+    def stepsIndex(self, times_index):
+        """
+        Map the time steps of the file to the emission time steps (-1 for the steps outside the emission time axis)
+        """
+        return array([times_index.get(step, -1) for step in self.steps], dtype=int64)
+
+    def readSlice(self, start, end):
+        return tuple(self.ds[var][start:end] for var in ['istep', 'ilat', 'ilon', 'resp'])
+
+    def readObs(self, obsname, times_index):
+        """
+        Same as Footprint.readObs, for an observation identified by its name (YYYYmmddHHMMSS)
+        """
+        if obsname not in self :
+            return None
+        iobs = self.obs[obsname]
+        istep, ilats, ilons, resp = self.readSlice(self.offsets[iobs], self.offsets[iobs+1])
+        itimes = self.stepsIndex(times_index)[istep]
+        if (itimes < 0).any():
+            return None
+        return itimes, ilats, ilons, resp
+
+    def readBlock(self, obsnames, times_index, shape):
+        """
+        Read the footprints of several observations (identified by their names), with a single contiguous read of the
+        range of elements spanned by these observations. Returns the (valid, offsets, index, resp) arguments of a
+        FootprintBlock.
+        """
+        nt, nlat, nlon = shape
+        iobs = array([self.obs.get(name, -1) for name in obsnames], dtype=int64)
+        counts = zeros(len(obsnames), dtype=int64)
+        present = iobs >= 0
+        counts[present] = self.offsets[iobs[present]+1]-self.offsets[iobs[present]]
+        valid = counts > 0
+        if not valid.any():
+            return valid, zeros(len(obsnames)+1, dtype=int64), zeros(0, dtype=int64), zeros(0, dtype=float32)
+
+        start = self.offsets[iobs[valid]].min()
+        end = self.offsets[iobs[valid]+1].max()
+        istep, ilat, ilon, resp = self.readSlice(start, end)
+
+        # Position, in the slice that has been read, of the elements of each requested observation
+        first = self.offsets[iobs[valid]]-start
+        nelem = counts[valid]
+        owner = repeat(arange(len(nelem)), nelem)
+        pos = arange(nelem.sum())-repeat(nelem.cumsum()-nelem-first, nelem)
+
+        # Discard the observations whose footprint is (even partly) outside of the emission time axis
+        itimes = self.stepsIndex(times_index)[istep[pos]]
+        outside = bincount(owner, weights=itimes < 0, minlength=len(nelem)) > 0
+        keep = ~outside[owner]
+        valid[valid] = ~outside
+        counts[~valid] = 0
+
+        index = (itimes[keep]*nlat+ilat[pos][keep])*nlon+ilon[pos][keep]
+        return valid, concatenate(([0], counts.cumsum())), index, resp[pos][keep]
+
+
+if __name__ == '__main__' :
+    p = ArgumentParser(description="Convert footprint files to the consolidated format")
+    p.add_argument('files', nargs='+', help="footprint files to convert")
+    p.add_argument('--dest', required=True, help="directory where the converted files are written (with the same file names)")
+    p.add_argument('--compression', default=None, help="HDF5 compression filter for the element datasets (e.g. gzip)")
+    p.add_argument('--verbosity', '-v', default='INFO')
+    args = p.parse_args(sys.argv[1:])
+
+    logger.setLevel(args.verbosity)
+
+    if not os.path.exists(args.dest):
+        os.makedirs(args.dest)
+    for file in tqdm(args.files, desc='Convert footprint files'):
+        convert(file, os.path.join(args.dest, os.path.basename(file)), compression=args.compression)
@@ -1,4 +1,5 @@
 import os
+import json
 from netCDF4 import Dataset
 from numpy import array, zeros, arange, array_equal
 from datetime import datetime
@@ -30,18 +31,23 @@ class Struct(dict):
                 self[cat] = other[cat]
         return self
 
-def WriteStruct(data, path, prefix=None):
+def WriteStruct(data, path, prefix=None, fmt=None):
     """
     Write the model input (control parameters)
+    The format is either netCDF (default) or a directory of memory-mappable arrays (fmt='mmap', or file names ending
+    with ".mmap", see WriteArrays)
     """
 
     # Create the filename and directory (if needed)
     if prefix is None :
         filename, path = path, os.path.dirname(path)
     else :
-        filename = os.path.join(path, '%s.nc' % prefix)
+        filename = os.path.join(path, '%s.%s' % (prefix, 'mmap' if fmt == 'mmap' else 'nc'))
     checkDir(path)
 
+    if fmt == 'mmap' or filename.endswith('.mmap'):
+        return WriteArrays(data, filename)
+
     # Write to a netCDF format
     with Dataset(filename, 'w') as ds:
         ds.createDimension('time_components', 6)
@@ -69,6 +75,10 @@ def ReadStruct(path, prefix=None):
         filename = path
     else :
         filename = os.path.join(path, '%s.nc' % prefix)
+        if not os.path.exists(filename) and os.path.isdir(os.path.join(path, '%s.mmap' % prefix)):
+            filename = os.path.join(path, '%s.mmap' % prefix)
+    if os.path.isdir(filename):
+        return ReadArrays(filename)
     with Dataset(filename) as ds:
         categories = ds.groups.keys()
         data = Struct()
@@ -86,6 +96,60 @@ def ReadStruct(path, prefix=None):
     return data
 
 
+def WriteArrays(data, path):
+    """
+    Write a Struct as a directory containing one .npy file per category (with the emissions, masked values converted
+    to NaN) and a header.json file with the time axes and coordinates. The files are written under temporary names
+    and then renamed, so that processes that have the previous version mapped in memory are not affected.
+    """
+    checkDir(path)
+    header = {}
+    for cat in [c for c in data.keys() if not 'cat_list' in c]:
+        fname = '%s.npy' % cat
+        with open(os.path.join(path, fname + '.tmp'), 'wb') as fid :
+            save(fid, ma.filled(data[cat]['emis'], nan).astype(float64))
+        os.replace(os.path.join(path, fname + '.tmp'), os.path.join(path, fname))
+        header[cat] = {
+            'file': fname,
+            'time_start': [x.isoformat() for x in data[cat]['time_interval']['time_start']],
+            'time_end': [x.isoformat() for x in data[cat]['time_interval']['time_end']],
+            'lats': asarray(data[cat]['lats'], dtype=float).tolist(),
+            'lons': asarray(data[cat]['lons'], dtype=float).tolist(),
+        }
+        if 'region' in data[cat]:
+            header[cat]['region'] = data[cat]['region']
+    with open(os.path.join(path, 'header.json.tmp'), 'w') as fid :
+        json.dump(header, fid)
+    os.replace(os.path.join(path, 'header.json.tmp'), os.path.join(path, 'header.json'))
+    logger.debug(f"Model parameters written to {path}")
+    return path
+
+
+def ReadArrays(path, mmap_mode='c'):
+    """
+    Read a Struct written by WriteArrays. The emissions are memory-mapped (copy-on-write by default): they are read
+    directly from the page cache, without any decoding, when they are used. Note that the transport reads (and
+    copies) the whole fields anyway, when stacking them (see kernels.stack_emis).
+    """
+    with open(os.path.join(path, 'header.json')) as fid :
+        header = json.load(fid)
+    data = Struct()
+    for cat, desc in header.items():
+        data[cat] = {
+            'emis': load(os.path.join(path, desc['file']), mmap_mode=mmap_mode),
+            'time_interval': {
+                'time_start': array(desc['time_start'], dtype='datetime64[us]').astype(datetime),
+                'time_end': array(desc['time_end'], dtype='datetime64[us]').astype(datetime),
+            },
+            'lats': array(desc['lats']),
+            'lons': array(desc['lons'])
+        }
+        if 'region' in desc :
+            data[cat]['region'] = desc['region']
+    logger.debug(f"Model parameters read from {path}")
+    return data
+
+
 def CreateStruct(categories, region, start, end, dt):
     times = arange(start, end, dt, dtype=datetime)
     #data = {'cat_list': categories}
@@ -5,11 +5,34 @@ import tarfile
 import tempfile
 from datetime import datetime
 from io import BytesIO
-from numpy import unique, nan
-from pandas import DataFrame, read_hdf, read_json, errors, read_csv
+from numpy import unique, nan, asarray, int64
+from pandas import DataFrame, read_hdf, read_json, errors, read_csv, concat
+from pandas.api.types import infer_dtype
+from . import columnar
+from .registry import SiteRegistry, SITE_KEY
 
 logger = logging.getLogger(__name__)
 
+# Columns that can be stored in single precision (see obsdb.compact)
+AUXILIARY_COLUMNS = ['lat', 'lon', 'alt', 'height', 'totals']
+
+# Columns of the imported observations that describe their site (see obsdb.addObservations)
+SITE_COLUMNS = ['lat', 'lon', 'alt', 'height', 'file', 'code', 'name']
+
+
+def time_components_to_datetime64(components):
+    """
+    Convert an array of time components (year, month, day, hour[, minute[, second]]) to datetime64[s] values
+    """
+    c = asarray(components, dtype=int64)
+    time = (c[:, 0]-1970).astype('datetime64[Y]') + (c[:, 1]-1).astype('timedelta64[M]')
+    time = time.astype('datetime64[D]') + (c[:, 2]-1).astype('timedelta64[D]')
+    time = time.astype('datetime64[s]')
+    for icol, seconds in zip(range(3, c.shape[1]), (3600, 60, 1)):
+        time += c[:, icol]*seconds
+    return time
+
+
 class obsdb:
     def __init__(self, filename=None, start=None, end=None, db=None):
         if db is not None :
@@ -40,7 +63,7 @@ class obsdb:
             }
             self.extraFields = {}
         if filename is not None :
-            self.load_tar(filename)
+            self.load(filename)
 
     def __getattr__(self, item):
         if '_parent' in vars(self):
@@ -80,6 +103,39 @@ class obsdb:
         )]
         self.sites = self.sites.loc[unique(self.observations.site), :]
 
+    def siteRegistry(self):
+        """
+        Returns a SiteRegistry (hash index by code, lat, lon, alt and height) of the sites of the database
+        """
+        return SiteRegistry(self.sites)
+
+    def joinSites(self, columns):
+        """
+        Returns the requested columns of the sites table for each observation (DataFrame with the same index as
+        self.observations), using a single join on the "site" column
+        """
+        return self.observations.loc[:, ['site']].join(self.sites.loc[:, columns], on='site').loc[:, columns]
+
+    def addObservations(self, observations, registry=None):
+        """
+        Add the observations of a DataFrame (with at least the SITE_COLUMNS and the "time", "obs" and "err" columns) to
+        the database. The sites are matched to the existing ones through a SiteRegistry, and the new sites are added
+        to self.sites.
+        """
+        registry = self.siteRegistry() if registry is None else registry
+        nsites = len(registry)
+        sites = observations.loc[:, SITE_COLUMNS].drop_duplicates(SITE_KEY)
+        sites.loc[:, 'site'] = registry.register(sites)
+        self.sites = registry.sites
+
+        obs = observations.merge(sites.loc[:, SITE_KEY + ['site']], on=SITE_KEY, how='left')
+        obs = obs.loc[:, ['time', 'lat', 'lon', 'alt', 'height', 'obs', 'err', 'code', 'site']]
+        if self.observations.shape[0] == 0 :
+            self.observations = obs.reindex(columns=self.observations.columns.union(obs.columns, sort=False))
+        else :
+            self.observations = concat([self.observations, obs], ignore_index=True, sort=False)
+        logger.info(f"{obs.shape[0]} observations imported, from {sites.shape[0]} sites ({len(registry)-nsites} new)")
+
     def SelectSites(self, sitelist):
         selection = [x in sitelist for x in self.observations.site]
         self.SelectObs(selection)
@@ -108,6 +164,78 @@ class obsdb:
                     db.observations.loc[db.observations.file == file, 'file'] = nan
         return db
 
+    def save(self, filename, compression=None):
+        """
+        Write the database, in the columnar (HDF5) format if the file name ends with .h5/.hdf/.hdf5, or as a tar.gz
+        archive of CSV files otherwise. "compression" (e.g. 'gzip' or 'lzf') only applies to the columnar format.
+        """
+        if columnar.is_columnar(filename):
+            logger.info("Writing observation database to %s", filename)
+            return columnar.save(self, filename, compression)
+        return self.save_tar(filename)
+
+    def load(self, filename, columns=None):
+        """
+        Read the database from a columnar (HDF5) file or from a tar.gz archive (the format is detected from the file
+        itself). For columnar files, the reading can be restricted to a subset of the observation columns.
+        """
+        if not columnar.is_columnar(filename):
+            return self.load_tar(filename)
+        columnar.load(self, filename, columns)
+        self.SelectTimes(self.start, self.end)
+        logger.info(f"{self.observations.shape[0]} observation read from {filename}")
+
+    def compact(self, float32=False):
+        """
+        Reduce the memory used by the observations table:
+        - string columns (site codes, footprint and file names, etc.) are converted to categoricals, if they contain
+          repeated values, which also makes comparisons such as "observations.footprint == filename" much faster;
+        - if "float32" is True (or a list of column names), the auxiliary columns (AUXILIARY_COLUMNS, or the columns
+          provided) are stored in single precision.
+        """
+        obs = self.observations
+        for col in obs.columns :
+            if obs[col].dtype == object and infer_dtype(obs[col], skipna=True) == 'string':
+                if obs[col].nunique() < 0.5*len(obs):
+                    obs[col] = obs[col].astype('category')
+        if float32 is True :
+            float32 = AUXILIARY_COLUMNS
+        for col in (float32 or []):
+            if col in obs.columns and obs[col].dtype.kind == 'f':
+                obs[col] = obs[col].astype('float32')
+
+    def memoryReport(self):
+        """
+        Returns the memory used by each column of the observations table (in MB), and logs the total
+        """
+        obs = self.observations
+        usage = obs.memory_usage(deep=True)
+        report = DataFrame({
+            'dtype': [str(obs.index.dtype)] + [str(obs[c].dtype) for c in obs.columns],
+            'MB': usage.values/1.e6
+        }, index=usage.index)
+        logger.info(f"Observations table: {len(obs)} rows, {report.MB.sum():.1f} MB")
+        return report
+
+    def save_columns(self, filename, columns):
+        """
+        Write only some columns of the observations table (with its index), in the columnar format
+        """
+        return columnar.save_columns(self.observations.loc[:, columns], filename)
+
+    def update_columns(self, filename):
+        """
+        Merge the columns written by "save_columns" in the observations table (matching rows by index). Existing
+        columns are overwritten for the rows present in the file, new columns are created.
+        """
+        df = columnar.read_columns(filename)
+        for col in df.columns :
+            if col in self.observations.columns and not df.index.equals(self.observations.index):
+                self.observations.loc[df.index, col] = df.loc[:, col]
+            else :
+                self.observations.loc[:, col] = df.loc[:, col]
+        logger.debug(f"Columns {', '.join(df.columns)} updated from {filename}")
+
     def save_tar(self, filename):
         logger.info("Writing observation database to %s", filename)
 
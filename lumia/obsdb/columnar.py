@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+"""
+Columnar (HDF5) storage of the observation databases: each table (observations, sites, files) is stored in a group,
+with one dataset per column, so that the column types are preserved (no date parsing on load), and that columns can
+be loaded individually. Object columns (e.g. columns with missing values) are stored according to the type of their
+values: strings, booleans, integers, floats, or JSON (dictionaries or lists), with a mask of the missing values.
+Columns mixing several of these types are refused.
+"""
+
+import os
+import json
+import logging
+from h5py import File, is_hdf5
+from numpy import asarray, array, empty, int64, float64, nan, bool_, integer, floating
+from pandas import DataFrame, Series, Categorical, Index, isnull
+
+logger = logging.getLogger(__name__)
+
+FORMAT = 'lumia-obsdb'
+VERSION = 1
+EXTENSIONS = ('.h5', '.hdf', '.hdf5')
+
+
+def is_columnar(filename):
+    """
+    Whether "filename" is (or, if it doesn't exist yet, should be written as) a columnar database
+    """
+    if os.path.exists(filename):
+        return is_hdf5(filename)
+    return filename.endswith(EXTENSIONS)
+
+
+# Types of the values of an object column, for each of the kinds it can be stored as
+OBJECT_KINDS = {
+    'str': (str,),
+    'bool': (bool, bool_),
+    'int': (int, integer),
+    'float': (float, floating),
+    'json': (dict, list)
+}
+
+
+def object_kind(values):
+    """
+    Kind of an object column, from the type of its (non-null) "values" (pandas Series). Raises a TypeError if the
+    values are of several (or unsupported) types.
+    """
+    types = set(type(v) for v in values)
+    for kind, accepted in OBJECT_KINDS.items():
+        # bool is a subclass of int, so it has to be excluded explicitly
+        if all(issubclass(t, accepted) and not (kind == 'int' and issubclass(t, (bool, bool_))) for t in types):
+            return kind
+    raise TypeError(f"Column {values.name} can't be stored: its values are of type(s) {', '.join(sorted(t.__name__ for t in types))}")
+
+
+def write_column(group, name, values, compression=None):
+    """
+    Write a column (pandas Series or Index) in "group", with a "kind" attribute describing how to decode it.
+    """
+    kwargs = {'compression': compression} if compression else {}
+    if values.dtype.name == 'category':
+        values = Series(values)
+        ds = group.create_dataset(name, data=values.cat.codes.values, **kwargs)
+        ds.attrs['kind'] = 'category'
+        ds.attrs['categories'] = json.dumps([str(c) for c in values.cat.categories])
+    elif values.dtype.kind == 'M':
+        ds = group.create_dataset(name, data=asarray(values, dtype='datetime64[ns]').view(int64), **kwargs)
+        ds.attrs['kind'] = 'datetime64[ns]'
+    elif values.dtype.kind == 'm':
+        ds = group.create_dataset(name, data=asarray(values, dtype='timedelta64[ns]').view(int64), **kwargs)
+        ds.attrs['kind'] = 'timedelta64[ns]'
+    elif values.dtype.kind in 'biuf':
+        ds = group.create_dataset(name, data=asarray(values), **kwargs)
+        ds.attrs['kind'] = 'numeric'
+    else :
+        values = Series(values, dtype=object)
+        null = isnull(values).values
+        kind = object_kind(values[~null])
+        if kind in ('str', 'json'):
+            encode = json.dumps if kind == 'json' else str
+            data = array([encode(v).encode('utf-8') if not n else b'' for (v, n) in zip(values, null)], dtype=bytes)
+        else :
+            dtype = {'bool': bool, 'int': int64, 'float': float64}[kind]
+            data = array([v if not n else 0 for (v, n) in zip(values, null)], dtype=dtype)
+        ds = group.create_dataset(name, data=data, **kwargs)
+        ds.attrs['kind'] = kind
+        if null.any():
+            group.create_dataset(f'{name}.null', data=null, **kwargs)
+
+
+def read_column(group, name):
+    ds = group[name]
+    kind = ds.attrs['kind']
+    data = ds[:]
+    if kind == 'category':
+        return Categorical.from_codes(data, json.loads(ds.attrs['categories']))
+    if kind == 'datetime64[ns]':
+        return data.view('datetime64[ns]')
+    if kind == 'timedelta64[ns]':
+        return data.view('timedelta64[ns]')
+    if kind == 'numeric':
+        return data
+    if kind == 'json':
+        values = empty(len(data), dtype=object)
+        for i, v in enumerate(data):
+            values[i] = json.loads(v) if v else None
+    elif kind in ('bool', 'int', 'float'):
+        values = array(data.tolist(), dtype=object)
+    else :
+        values = Series(data, dtype=object).str.decode('utf-8').values
+    if f'{name}.null' in group :
+        values[group[f'{name}.null'][:]] = nan
+    return values
+
+
+def write_table(group, df, compression=None):
+    group.attrs['columns'] = json.dumps([str(c) for c in df.columns])
+    group.attrs['index'] = json.dumps(df.index.name)
+    write_column(group, '__index__', df.index, compression)
+    for icol, col in enumerate(df.columns):
+        write_column(group, f'c{icol}', df.loc[:, col], compression)
+
+
+def read_table(group, columns=None):
+    """
+    Read a table (or only the requested columns of that table)
+    """
+    allcolumns = json.loads(group.attrs['columns'])
+    columns = allcolumns if columns is None else [c for c in columns if c in allcolumns]
+    index = Index(read_column(group, '__index__'), name=json.loads(group.attrs['index']))
+    return DataFrame({col: read_column(group, f'c{allcolumns.index(col)}') for col in columns}, index=index, columns=columns)
+
+
+def read_columns(filename, columns=None, table='observations'):
+    """
+    Read only the requested columns of one table of a columnar database file
+    """
+    with File(filename, 'r') as fid :
+        return read_table(fid[table], columns)
+
+
+def save_columns(df, filename, compression=None, table='observations'):
+    """
+    Write some columns of a table (e.g. the ones modified by a transport run), so that they can be merged in another
+    copy of the database (see obsdb.update_columns)
+    """
+    with File(filename, 'w') as fid :
+        fid.attrs['format'] = FORMAT
+        fid.attrs['version'] = VERSION
+        write_table(fid.create_group(table), df, compression)
+    return filename
+
+
+def save(db, filename, compression=None):
+    """
+    Write the tables of an obsdb instance (the fields listed in its "io" attribute) in a columnar database file.
+    "compression" can be any of the h5py compression filters (e.g. 'gzip' or 'lzf'), or None (the default, fastest).
+    """
+    with File(filename, 'w') as fid :
+        fid.attrs['format'] = FORMAT
+        fid.attrs['version'] = VERSION
+        for field in db.io :
+            write_table(fid.create_group(field), getattr(db, field), compression)
+    return filename
+
+
+def load(db, filename, columns=None):
+    """
+    Read the tables of a columnar database file in an obsdb instance. If "columns" is provided, only these columns of
+    the observations table are read.
+    """
+    with File(filename, 'r') as fid :
+        for field in fid :
+            setattr(db, field, read_table(fid[field], columns if field == 'observations' else None))
+
+
+def convert(src, dest, compression=None):
+    """
+    Convert an observation database archive (tar.gz) to the columnar format
+    """
+    from lumia.obsdb import obsdb
+    db = obsdb(src)
+    return db.save(dest, compression=compression)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    p = ArgumentParser(description="Convert tar.gz observation databases to the columnar (HDF5) format")
+    p.add_argument('files', nargs='+', help="tar.gz observation database(s)")
+    p.add_argument('--compression', default=None, help="h5py compression filter (e.g. gzip or lzf)")
+    args = p.parse_args()
+
+    for src in args.files :
+        dest = src.replace('.tar.gz', '') + '.h5'
+        convert(src, dest, args.compression)
+        logger.info(f"{src} converted to {dest}")
@@ -4,127 +4,114 @@ import os
 import glob
 import logging
 from datetime import datetime
-from numpy import inf, loadtxt, array, nan, unique, count_nonzero
+from functools import partial
+from multiprocessing import Pool
+from numpy import inf, nan, count_nonzero, full, datetime64
 from tqdm import tqdm
-from pandas import DataFrame
-from lumia.obsdb import obsdb as obsdb_base
+from pandas import DataFrame, read_csv, concat
+from lumia.obsdb import obsdb as obsdb_base, time_components_to_datetime64
 
 logger = logging.getLogger(__name__)
 
-class obsdb(obsdb_base):
-    def importFromPath(self, path, pattern='*.co2',
-                       date_range=(datetime(1000,1,1),datetime(3000,1,1)),
-                       lat_range=(-inf,inf), lon_range=(-inf,inf),
-                       exclude_mobile=True):
-        files = sorted(glob.glob(os.path.join(path, pattern)))
-        for file in tqdm(files, desc='Import obs files from {os.path.join(path, pattern)}'):
-            obs = self.importASCII(file, date_range, lat_range, lon_range, exclude_mobile)
-            if obs is not None :
-                self.addObs(obs)
-        
-        self.fixDuplicatedSiteCodes()
-
-    def fixDuplicatedSiteCodes(self):
-        sitecodes = unique(self.sites.code)
-        for code in sitecodes :
-            if count_nonzero(self.sites.code.values == code) > 1 :
-                heights = self.sites.loc [self.sites.code == code, 'height'].values
-                oldcodes = self.sites.loc[self.sites.code == code, 'code'].values
-                newcodes = [f'{s.upper():3s}{h:03.0f}' for (s, h) in zip(oldcodes, heights)]
-                self.sites.loc[self.sites.code == code, 'code'] = newcodes
+TIME_COLUMNS = ['Year', 'Month', 'Day', 'Hour', 'Minute']
 
-    def importASCII(self, filename, date_range=(datetime(1000,1,1), datetime(3000,1,1)),
-                    lat_range=(-inf, inf), lon_range=(-inf, inf), exclude_mobile=True):
 
-        header = self.read_header(filename)
+def read_header(fid):
+    """
+    Parse the header ("#" lines) of an opened EUROCOM ASCII file, and leave the file positioned at the first data line
+    """
+    header = {}
+    lines = []
+    while True :
+        pos = fid.tell()
+        line = fid.readline()
+        if not line.startswith('#'):
+            fid.seek(pos)
+            break
+        lines.append(line.strip('#').strip())
+    for line in lines :
+        if ':' in line :
+            key, value = line.split(':', 1)
+            if 'LATITUDE' in key: header['site_latitude'] = float(value.strip().split()[0])
+            if 'LONGITUDE' in key: header['site_longitude'] = float(value.strip().split()[0])
+            if 'ALTITUDE' in key: header['site_altitude'] = float(value.strip().split()[0])
+            if 'HEADER LINES' in key: header['nlines_header'] = int(value.strip())
+            if 'CODE' in key: header['site_code'] = value.strip()
+            if 'STATION NAME' in key: header['name'] = value.strip()
+            if key == 'PARAMETER': header['param'] = value.strip().lower()
+            if key == 'SAMPLING HEIGHTS' : header['sampling_heights'] = [float(v.strip().split(' ')[0]) for v in value.split(',')]
+    header['columns'] = lines[-1].strip('#').split(';')
+    return header
 
-        # Import the data (if needed):
-        observations = None
-        continue_import = False
-        if lat_range[0] <= header['site_latitude'] <= lat_range[1] :
-            if lon_range[0] <= header['site_longitude'] <= lon_range[1]:
-                continue_import = True
-        if continue_import :
-            observations = self.readASCIIData_fixedPlatform(filename, header, date_range[0], date_range[1])
-        return observations
 
-    def addObs(self, observations):
-        # Convert to DataFrame:
-        observations = DataFrame.from_dict(observations)
-        sites = observations.loc[:, ['lat', 'lon', 'alt', 'height', 'file', 'code', 'name']].drop_duplicates()
-        for dummy, row in sites.iterrows():
-            # Check if a corresponding site already exists in the database :
-            if self.sites.loc[(self.sites.reindex(columns=sites.columns) == row).all(axis=1)].shape[0] == 0 :
-                self.sites = self.sites.append(row, ignore_index=True)
+def readASCII(filename, date_range=(datetime(1000,1,1), datetime(3000,1,1)), lat_range=(-inf, inf), lon_range=(-inf, inf)):
+    """
+    Read the observations of a EUROCOM ASCII file (fixed platform) in the requested space/time domain, in a single
+    pass (header and data). Returns a dictionary of column arrays, or None if no observation is selected.
+    """
+    with open(filename, 'r') as fid :
+        header = read_header(fid)
+        if not (lat_range[0] <= header['site_latitude'] <= lat_range[1] and lon_range[0] <= header['site_longitude'] <= lon_range[1]):
+            return None
+        columns = TIME_COLUMNS + [header['param'], 'Stdev', 'SamplingHeight']
+        data = read_csv(fid, sep=';', header=None, names=header['columns'], usecols=columns, dtype={c: float for c in columns})
 
-            # Retrieve the index of the site (there should be only one!):
-            site = self.sites.loc[(self.sites.loc[:, sites.columns] == row).all(axis=1)]
-            assert site.shape[0] == 1, logger.error(f"Error importing data from {os.path.basename(site.file)}, {site.shape[0]} entries found for site, instead of exactly 1 expected")
-            isite = site.index[0]
+    time = time_components_to_datetime64(data.loc[:, TIME_COLUMNS].values)
+    selection = (datetime64(date_range[0], 's') <= time) & (time <= datetime64(date_range[1], 's'))
+    nobs = count_nonzero(selection)
+    if nobs == 0 :
+        return None
+    data = data.loc[selection]
 
-            # Create the rows to be added to the self.observations dataframe:
-            obs = observations.loc[
-                    (observations.loc[:, sites.columns] == row).all(axis=1),
-                    ['time', 'lat', 'lon', 'alt', 'height', 'obs', 'err', 'code']
-            ]
-            obs.loc[:, 'site'] = isite
+    obs = data.loc[:, header['param']].values
+    obs[obs < 0] = nan
+    err = data.loc[:, 'Stdev'].values
+    err[(err < 0) | (err == 999.999)] = nan
+    return {
+        'time': time[selection].astype('datetime64[ns]'),
+        'lat': full(nobs, header['site_latitude']),
+        'lon': full(nobs, header['site_longitude']),
+        'alt': full(nobs, header['site_altitude']),
+        'height': data.loc[:, 'SamplingHeight'].values,
+        'obs': obs,
+        'err': err,
+        'file': full(nobs, filename, dtype=object),
+        'code': full(nobs, header['site_code'].lower(), dtype=object),
+        'name': full(nobs, header['name'], dtype=object)
+    }
 
-            # Append to self.observations:
-            self.observations = self.observations.append(obs, sort=False)
 
+class obsdb(obsdb_base):
+    def importFromPath(self, path, pattern='*.co2',
+                       date_range=(datetime(1000,1,1),datetime(3000,1,1)),
+                       lat_range=(-inf,inf), lon_range=(-inf,inf),
+                       exclude_mobile=True, nproc=None):
+        """
+        Import the observations of all the EUROCOM ASCII files matching "pattern" in "path". The files are parsed in
+        parallel, on "nproc" processes (by default, all the available CPUs), and the observations are added to the
+        database at once.
+        """
+        files = sorted(glob.glob(os.path.join(path, pattern)))
+        read = partial(readASCII, date_range=date_range, lat_range=lat_range, lon_range=lon_range)
+        desc = f'Import obs files from {os.path.join(path, pattern)}'
+        if nproc == 1 or len(files) < 2 :
+            data = [read(f) for f in tqdm(files, desc=desc)]
+        else :
+            with Pool(nproc) as p :
+                data = list(tqdm(p.imap(read, files), total=len(files), desc=desc))
+        data = [DataFrame.from_dict(d) for d in data if d is not None]
+        registry = self.siteRegistry()
+        if len(data) > 0 :
+            self.addObservations(concat(data, ignore_index=True), registry)
 
-    def readASCIIData_fixedPlatform(self, filename, header, tmin=datetime(1000,1,1), tmax=datetime(3000,1,1)):
-        data = loadtxt(filename, skiprows=header['nlines_header'], dtype=str,delimiter=';')
-        ihh = header['columns'].index('Year')
-        imn = header['columns'].index('Minute')
-        time = array([datetime(yy, mm, dd, hh, mn) for (yy, mm, dd, hh, mn) in data[:, ihh:imn+1].astype(int)])
-        selection = (time >= tmin) * (time <= tmax)
-        nobs = len(selection)
-        obs = data[:, header['columns'].index(header['param'])]
-        obs[obs == ''] = 'nan'
-        obs = obs.astype(float)
-        obs[obs < 0] = nan
-        err = data[:, header['columns'].index('Stdev')]
-        err[err == ''] = 'nan'
-        err = err.astype(float)
-        err[err < 0] = nan
-        err[err == 999.999] = nan
-        if nobs > 0 :
-            try :
-                observations = {
-                    'time':time[selection],
-                    'lat':array([header['site_latitude']] * nobs),
-                    'lon': array([header['site_longitude']] * nobs),
-                    'alt': array([header['site_altitude']] * nobs),
-                    'height': data[:, header['columns'].index('SamplingHeight')].astype(float),
-                    'obs':obs.astype(float),
-                    'err':err.astype(float),
-                    'file':array([filename]*nobs),
-                    'code':array([header['site_code'].lower()]*nobs),
-                    'name':array([header['name']]*nobs)
-                }
-                return observations
-            except :
-                import pdb; pdb.set_trace()
-        return None
+        self.fixDuplicatedSiteCodes(registry)
 
-    def read_header(self, filename):
-        header = {}
-        with open(filename, 'r') as fid :
-            lines = [l.strip('#').strip() for l in fid.readlines() if l.startswith('#')]
-        for line in lines :
-            if ':' in line :
-                try :
-                    key, value = line.split(':',1)
-                    if 'LATITUDE' in key: header['site_latitude'] = float(value.strip().split()[0])
-                    if 'LONGITUDE' in key: header['site_longitude'] = float(value.strip().split()[0])
-                    if 'ALTITUDE' in key: header['site_altitude'] = float(value.strip().split()[0])
-                    if 'HEADER LINES' in key: header['nlines_header'] = int(value.strip())
-                    if 'CODE' in key: header['site_code'] = value.strip()
-                    if 'STATION NAME' in key: header['name'] = value.strip()
-                    if key == 'PARAMETER': header['param'] = value.strip().lower()
-                    if key == 'SAMPLING HEIGHTS' : header['sampling_heights'] = [float(v.strip().split(' ')[0]) for v in value.split(',')]
-                except :
-                    import pdb; pdb.set_trace()
-        header['columns'] = lines[-1].strip('#').split(';')
-        return header
+    def fixDuplicatedSiteCodes(self, registry=None):
+        """
+        Give a distinct code (upper-case code followed by the sampling height) to the sites that share their code
+        """
+        registry = self.siteRegistry() if registry is None else registry
+        for code, ids in registry.duplicatedCodes().items():
+            heights = self.sites.loc[ids, 'height'].values
+            registry.rename(ids, [f'{code.upper():3s}{h:03.0f}' for h in heights])
+        self.sites = registry.sites
@@ -2,23 +2,29 @@
 
 import os
 import logging
-import subprocess
 from multiprocessing import Pool
 import h5py
 from xarray import DataArray, open_dataarray
-from numpy import unique, array, size, zeros
+from pandas import DataFrame
+from numpy import unique, array, asarray, size, zeros, add, int64, datetime_as_string
 from lumia.obsdb import obsdb as obsdb_base
 from lumia import tqdm
 from lumia.Tools import system_tools
+from lumia.footprints.storage import is_consolidated, ConsolidatedStore
+from lumia.footprints.index import FootprintIndex
+from lumia.footprints.staging import FootprintStager
 
 logger = logging.getLogger(__name__)
 
 def concat_footprints(file):
     with h5py.File(file, 'r') as ds :
-        observations = [k for k in ds.keys() if not k in ['latitudes', 'longitudes']]
         lats = ds['latitudes'][:]
         lons = ds['longitudes'][:]
         field = zeros((len(lats), len(lons)))
+        if is_consolidated(ds):
+            add.at(field, (ds['ilat'][:], ds['ilon'][:]), ds['resp'][:])
+            return DataArray(field, coords=[lats, lons], dims=['lats', 'lons'])
+        observations = [k for k in ds.keys() if not k in ['latitudes', 'longitudes']]
         for obs in observations:
             for fp in ds[obs].keys():
                 try :
@@ -36,13 +42,28 @@ class obsdb(obsdb_base):
         super().__init__(**kwargs)
         self.footprints_path = kwargs.get('footprints_path', None)
 
-    def setupFootprints(self, path=None, names=None, cache=None):
+    def setupFootprints(self, path=None, names=None, cache=None, index=None, drop_missing=False, staging_workers=8):
+        """
+        Find the footprint files of the observations, copy them to the "cache" directory (if provided), and check
+        which observations have a footprint.
+        :param index: path to a footprint index database (see lumia.footprints.index), or True to use the default
+        "footprints.index.sqlite" file, in the directory where the footprints are read from. If not set, the footprint
+        files are scanned directly.
+        :param drop_missing: remove the observations without footprint from the database
+        :param staging_workers: number of files copied concurrently to the "cache" directory
+        """
         self.footprints_path = path if path is not None else self.footprints_path
         if self.footprints_path is None :
             logger.error("Unspecified footprints path")
 
         self.observations.loc[:, 'footprint'] = self._genFootprintNames(names)
-        self._checkFootprints(cache=cache)
+        if index is True :
+            index = os.path.join(self.footprints_path if cache in [None, False] else cache, 'footprints.index.sqlite')
+        self._checkFootprints(cache=cache, index=index, staging_workers=staging_workers)
+        if drop_missing :
+            nobs = self.observations.shape[0]
+            self.SelectObs(self.observations.footprint_exists.fillna(False).astype(bool).values)
+            logger.info(f"{nobs-self.observations.shape[0]} observations without footprint removed from the database")
         self.setup = True
 
     def setupUncertainties(self, errvec):
@@ -73,62 +94,86 @@ class obsdb(obsdb_base):
         Deduct the names of the footprint files based on their sitename, sampling height and observation time
         Optionally, a user-specified list (for example following a different pattern) can be speficied here.
         :param fnames: A list of footprint file names.
-        :return: A list of footprint file names, or the optional "fnames" argument (if it isn't set to None)
+        :return: An array of footprint file paths (from the generated names, or from the optional "fnames" argument)
         """
         if fnames is None :
-            # Create the footprint theoretical filenames :
-            for isite, site in tqdm(self.sites.iterrows(), leave=leave_pbar, desc='Generate footprint file names (step 1/3)', total=self.sites.shape[0]):
-                self.observations.loc[self.observations.site == isite, 'code'] = site.code
-#            codes = [self.sites.loc[s].code for s in tqdm(self.observations.site, leave=False, desc='Generate footprint file names (step 1/3)')]
-            fnames = array(
-                ['%s.%im.%s.h5'%(c.lower(), z, t.strftime('%Y-%m')) for (c, z, t) in tqdm(zip(
-                    self.observations.code, self.observations.height, self.observations.time
-                ), leave=leave_pbar, desc='Generate footprint file names (step 2/3)', total=self.observations.shape[0])]
-            )
-        fnames = [os.path.join(self.footprints_path, f) for f in tqdm(fnames, leave=leave_pbar, desc='Generate footprint file names (step 2/3)')]
-        return fnames
-
-    def _checkCacheFile(self, filename, cache):
+            # Create the footprint theoretical filenames ("<code>.<height>m.<YYYY-mm>.h5"), with a single join between
+            # the sites and observations tables and vectorized string operations :
+            sites = self.joinSites(['code'])
+            self.observations.loc[:, 'code'] = sites.code
+            missing = self.observations.height.isna()
+            if missing.any():
+                raise ValueError(f"The sampling height of {missing.sum()} observations is missing (e.g. obs {missing.idxmax()}), their footprint file names can't be generated")
+            heights = self.observations.height.values.astype(int64).astype(str)
+            months = datetime_as_string(self.observations.time.values.astype('datetime64[M]'))
+            fnames = sites.code.str.lower() + '.' + heights + 'm.' + months + '.h5'
+        return os.path.join(self.footprints_path, '') + asarray(fnames, dtype=object)
+
+    def _stageFootprints(self, cache=None, nworkers=8):
+        """
+        Copy the footprint files of the observations to the "cache" directory, on "nworkers" threads (only the files
+        missing from the cache or modified since they were staged are copied, see lumia.footprints.staging), and point
+        the "footprint" column to the staged files (or to None, for the files that can't be found).
+        Returns the list of footprint files available.
+        """
+        files = unique(self.observations.footprint.dropna())
         if cache in [None, False] :
-            if os.path.exists(filename) :
-                return filename
-            else :
-                return None
-        file_in_cache = filename.replace(self.footprints_path, cache)
-        system_tools.checkDir(cache)
-        if not os.path.exists(file_in_cache):
-            if not os.path.exists(filename):
-                logger.warning('File %s not found! no footprints will be read from it',filename)
-                file_in_cache = None
-            elif cache != self.footprints_path:
-                logger.debug(f'File <s>{os.path.basename(filename)}</s> found in <s>{self.footprints_path}</s>')
-                subprocess.check_call(['rsync', '--copy-links', filename, file_in_cache])
+            return [f for f in files if os.path.exists(f)]
+        if os.path.abspath(cache) == os.path.abspath(self.footprints_path):
+            paths = {f: f if os.path.exists(f) else None for f in files}
         else :
-            logger.debug(f'File <s>{os.path.basename(filename)}</s> already in <s>{cache}</s>')
-        self.observations.loc[self.observations.footprint == filename, 'footprint'] = file_in_cache
-        return file_in_cache
+            system_tools.checkDir(cache)
+            paths = FootprintStager(self.footprints_path, cache, nworkers).stage(files)
+        self.observations.loc[:, 'footprint'] = self.observations.footprint.map(paths)
+        return [f for f in paths.values() if f is not None]
 
-    def _checkFootprints(self, cache=None):
-        footprint_files = unique(self.observations.footprint)
+    def _checkFootprints(self, cache=None, index=None, staging_workers=8):
+        footprint_files = self._stageFootprints(cache, staging_workers)
+
+        if index is not None :
+            self._checkFootprintsIndex(index)
+            return
 
         # Loop over the footprint files (not on the obs, for efficiency)
         for fpf in tqdm(footprint_files, desc='Checking footprints'):
 
-            # 1st, check if the footprint exists, and migrate it to cache if needed:
-            fpf = self._checkCacheFile(fpf, cache)
-
-            # Then, look if the file has all the individual obs footprints it's supposed to have
+            # Look if the file has all the individual obs footprints it's supposed to have
             if fpf is not None :
                 fp = h5py.File(fpf, mode='r')
 
                 # Times of the obs that are supposed to be in this file
                 times = [x.to_pydatetime() for x in self.observations.loc[self.observations.footprint == fpf, 'time']]
 
-                # Check if a footprint exists, for each time
-                fp_exists = array([x.strftime('%Y%m%d%H%M%S') in fp for x in times])
+                if is_consolidated(fp):
+                    store = ConsolidatedStore(fp)
+                    fp_exists = array([x.strftime('%Y%m%d%H%M%S') in store for x in times], dtype=bool)
+                else :
+                    # Check if a footprint exists, for each time
+                    fp_exists = array([x.strftime('%Y%m%d%H%M%S') in fp for x in times])
 
-                # Some footprints may exist but be empty, get rid of them
-                fp_exists[fp_exists] = [size(fp[x.strftime('%Y%m%d%H%M%S')].keys()) > 0 for x in array(times)[fp_exists]]
+                    # Some footprints may exist but be empty, get rid of them
+                    fp_exists[fp_exists] = [size(fp[x.strftime('%Y%m%d%H%M%S')].keys()) > 0 for x in array(times)[fp_exists]]
+                fp.close()
 
                 # Store that ...
                 self.observations.loc[self.observations.footprint == fpf, 'footprint_exists'] = fp_exists.astype(bool)
+
+    def _checkFootprintsIndex(self, filename):
+        """
+        Check which observations have a footprint using a FootprintIndex (only the files modified since the last
+        check are re-scanned). The number of elements and total sensitivity of each footprint are also stored in the
+        "footprint_nnz" and "footprint_total" columns.
+        """
+        index = FootprintIndex(filename)
+        files = unique(self.observations.footprint.dropna())
+        index.update(files)
+        entries = index.select(files).rename(columns={'filename': 'footprint'})
+
+        keys = DataFrame({
+            'footprint': self.observations.footprint.values,
+            'obs': self.observations.time.dt.strftime('%Y%m%d%H%M%S').values
+        })
+        entries = keys.merge(entries, on=['footprint', 'obs'], how='left')
+        self.observations.loc[:, 'footprint_exists'] = (entries.nsteps.fillna(0) > 0).values
+        self.observations.loc[:, 'footprint_nnz'] = entries.nnz.fillna(0).values
+        self.observations.loc[:, 'footprint_total'] = entries.total.fillna(0).values
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""
+Hash index of the sites of an observation database, used to match the sites of imported observations with the
+existing ones without scanning the whole sites table.
+"""
+
+import logging
+from numpy import array, arange, int64
+from pandas import concat, isnull
+
+logger = logging.getLogger(__name__)
+
+# Columns identifying a site
+SITE_KEY = ['code', 'lat', 'lon', 'alt', 'height']
+
+
+def site_keys(df):
+    """
+    Returns the (code, lat, lon, alt, height) keys of the rows of a DataFrame, as a list of tuples (missing values
+    are replaced by None, so that they compare equal)
+    """
+    columns = [[None if isnull(v) else v for v in df.loc[:, col].values] for col in SITE_KEY]
+    return list(zip(*columns))
+
+
+class SiteRegistry:
+    """
+    Registry of the sites of a database (obsdb.sites DataFrame), indexed by their (code, lat, lon, alt, height) key,
+    and by code.
+    """
+    def __init__(self, sites):
+        self.sites = sites
+        self.index = {}
+        self.codes = {}
+        self.add(site_keys(sites), sites.index)
+        self.next = 0 if sites.shape[0] == 0 else int(sites.index.max())+1
+
+    def add(self, keys, ids):
+        for key, isite in zip(keys, ids):
+            self.index[key] = isite
+            self.codes.setdefault(key[0], []).append(isite)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def register(self, candidates):
+        """
+        Returns the site id of each row of "candidates" (DataFrame with at least the SITE_KEY columns, and optionally
+        other columns of the sites table, such as "name" or "file"), as an int64 array. The sites that are not yet
+        in the registry are added to the sites table at once, with the other columns of their first occurrence.
+        """
+        keys = site_keys(candidates)
+        new = {}
+        for irow, key in enumerate(keys):
+            if key not in self.index and key not in new :
+                new[key] = irow
+        if len(new) > 0 :
+            ids = arange(self.next, self.next+len(new))
+            added = candidates.iloc[list(new.values())].set_axis(ids, axis=0)
+            columns = self.sites.columns.union(added.columns, sort=False)
+            if self.sites.shape[0] == 0 :
+                self.sites = added.reindex(columns=columns)
+            else :
+                self.sites = concat([self.sites, added], sort=False).reindex(columns=columns)
+            self.add(new.keys(), ids)
+            self.next += len(new)
+        return array([self.index[k] for k in keys], dtype=int64)
+
+    def duplicatedCodes(self):
+        """
+        Returns a {code: site ids} dictionary of the codes used by more than one site (e.g. the levels of a tower)
+        """
+        return {code: ids for (code, ids) in self.codes.items() if len(ids) > 1}
+
+    def rename(self, ids, codes):
+        """
+        Change the code of the sites "ids" to "codes", in the sites table and in the registry
+        """
+        ids = list(ids)
+        for isite, key in zip(ids, site_keys(self.sites.loc[ids])):
+            del self.index[key]
+            self.codes[key[0]].remove(isite)
+            if len(self.codes[key[0]]) == 0 :
+                del self.codes[key[0]]
+        self.sites.loc[ids, 'code'] = codes
+        self.add(site_keys(self.sites.loc[ids]), ids)
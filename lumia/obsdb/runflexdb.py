@@ -11,10 +11,10 @@ class RunFlexDB(FootprintDB):
         Read settings from a station list file
         """
         slist = self.parse_config_file(config_file)
-        for isite, site in self.sites.iterrows():
-            self.observations.loc[self.observations.site == isite, 'code'] = site.code
-            self.observations.loc[self.observations.site == isite, 'siteAlt'] = site.alt
-            self.observations.loc[self.observations.site == isite, 'kindz'] = slist[site.code]['kindz']
+        sites = self.joinSites(['code', 'alt'])
+        self.observations.loc[:, 'code'] = sites.code
+        self.observations.loc[:, 'siteAlt'] = sites.alt
+        self.observations.loc[:, 'kindz'] = sites.code.map({code: slist[code]['kindz'] for code in self.sites.code.unique()})
 
     def export(self, filename):
         self.observations.to_hdf(filename, 'obs', mode='w')
@@ -5,11 +5,50 @@ import shutil
 import subprocess
 import logging
 import tempfile
+import atexit
+import importlib.util
+import json
+from pandas.util import hash_pandas_object
 from lumia.Tools import checkDir, colorize
 from .obsdb import obsdb
+from .obsdb.columnar import read_columns, save_columns
 
 logger = logging.getLogger(__name__)
 
+
+class TransportServer:
+    """
+    Transport model process (started with the --serve flag, possibly on several MPI ranks), kept alive between the
+    transport runs: the requests are sent on its standard input, and it replies on its standard output once each of
+    them is done.
+    """
+    def __init__(self, cmd):
+        logger.info(colorize(' '.join(cmd), 'g'))
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, close_fds=True)
+
+    def request(self, **request):
+        """
+        Send a request (see Lagrange.execute in the transport model), wait for it to be executed, and return whether
+        it was successful
+        """
+        try :
+            self.proc.stdin.write(json.dumps(request) + '\n')
+            self.proc.stdin.flush()
+        except BrokenPipeError :
+            logger.error(f"The transport server (pid {self.proc.pid}) is not running anymore")
+            return False
+        return self.proc.stdout.readline().strip() == 'ok'
+
+    def close(self):
+        if self.proc.poll() is None :
+            try :
+                self.proc.stdin.write(json.dumps({'cmd': 'stop'}) + '\n')
+                self.proc.stdin.close()
+            except BrokenPipeError :
+                pass
+        self.proc.wait()
+
+
 class transport(object):
     name = 'lagrange'
     def __init__(self, rcf, obs=None, formatter=None):
@@ -22,8 +61,39 @@ class transport(object):
             self.readStruct = formatter.ReadStruct
             self.createStruct = formatter.CreateStruct
 
+        # By default (model.transport.inprocess), the transport model is imported and run in the current process, so
+        # that its workers and footprint caches are kept alive through the whole inversion. Otherwise (and always with
+        # MPI), it runs in a separate process, which is also kept alive between the runs and receives requests
+        # (model.transport.server), or, if that is disabled, which is restarted for each run.
+        mpi = self.rcf.get('model.transport.mpi', default=0)
+        self.inprocess = self.rcf.get('model.transport.inprocess', default=not mpi)
+        if self.inprocess and mpi :
+            logger.warning("The transport model can't use MPI in-process, model.transport.mpi is ignored")
+        self.use_server = self.rcf.get('model.transport.server', default=True)
+        self.model = None
+        self.server = None
+        atexit.register(self.close)
+
+        # Format of the emission and adjoint files exchanged with the transport model (only used out of process): raw
+        # arrays ("mmap", faster to read, as they need no decoding) or netCDF ("netcdf")
+        self.exchange = self.rcf.get('model.transport.exchange', default='mmap')
+
+        # Format of the observation databases exchanged with the transport model: columnar ("h5") or "tar.gz"
+        self.dbformat = self.rcf.get('model.transport.obsdb.format', default='h5')
+
+        # The full database is sent to the transport model only when the observations themselves change (see
+        # self.stageObs), between the runs only the modified columns are exchanged.
+        self.staged = None
+        self.model_key = None
+
     def setupObs(self, obsdb):
         self.db = obsdb
+        self.forward_columns = []
+        # Compacting the database changes the dtypes of the caller's observation table, so it is only done on request
+        # (the transport model compacts its own copy anyway)
+        if self.rcf.get('observations.compact', default=False):
+            self.db.compact(float32=self.rcf.get('observations.float32', default=False))
+            self.db.memoryReport()
 
     def save(self, path=None, tag=None, structf=None):
         """
@@ -36,87 +106,206 @@ class transport(object):
 
         self.rcf.write(os.path.join(path, 'transport.%src'%tag))
         self.db.save_tar(os.path.join(path, 'observations.%star.gz'%tag))
-        if structf is not None :
+        if structf is not None and os.path.isdir(structf):
+            shutil.copytree(structf, os.path.join(path, os.path.basename(structf)), dirs_exist_ok=True)
+        elif structf is not None :
             shutil.copy(structf, path)
 
     def runForward(self, struct, step=None):
         """
-        Prepare input data for a forward run, launch the actual transport model in a subprocess and retrieve the results
-        The eventual parallelization is handled by the subprocess directly.        
+        Forward run: run the transport model (in-process, or through files) for the emissions in "struct", store the
+        results in the observation database, and return the model-data mismatches.
         """
         #if struct is None : struct = self.controlstruct
         self.check_init()
-
-        # read model-specific info
         rundir = self.rcf.get('path.run')
-        executable = self.rcf.get("model.transport.exec")
-        
-        # Write model inputs:
-        emf = self.writeStruct(struct, rundir, 'modelData.%s'%step)
-        dbf = self.db.save_tar(os.path.join(rundir, 'observations.%s.tar.gz'%step))
-        rcf = self.rcf.write(os.path.join(rundir, f'forward.{step}.rc'))
-        checkf = os.path.join(tempfile.mkdtemp(dir=rundir), 'forward.ok')
-        
-        # Run the model
-        cmd = ['python', executable, '--rc', rcf, '--forward', '--db', dbf, '--emis', emf, '--checkfile', checkf]
-        logger.info(colorize(' '.join([x for x in cmd]), 'g'))
-        pid = subprocess.Popen(cmd, close_fds=True)
-        pid.wait()
 
-        # Check that the run was successful:
-        self.check_success(checkf, "Forward run failed, exiting ...")
-
-        # Retrieve results :
-        db = obsdb(filename=dbf)
-        self.db.observations.loc[:, 'foreground'] = db.observations.loc[:, 'foreground']
-        self.db.observations.loc[:, 'model'] = db.observations.loc[:, 'model']
-        self.db.observations.loc[:, 'mismatch'] = \
-            self.db.observations.loc[:,'background'] + \
-            self.db.observations.loc[:,'foreground'] - \
-            self.db.observations.loc[:,'obs']
-        self.db.observations.loc[:, step] = self.db.observations.loc[:, 'background']+self.db.observations.loc[:, 'foreground']
+        if self.inprocess :
+            emf = None
+            results = self.getModel().forwardResults(struct)
+        else :
+            emf = self.writeStruct(struct, rundir, 'modelData.%s'%step, fmt=self.exchange)
+            resf = os.path.join(rundir, f'forward.{step}.h5')
+            self.execute('forward', emis=emf, output=resf)
+            results = read_columns(resf)
+        self.storeForward(results, step)
 
         # Output if needed:
         if self.rcf.get('transport.output'):
             if step in self.rcf.get('transport.output.steps'):
+                if emf is None :
+                    emf = self.writeStruct(struct, rundir, 'modelData.%s'%step, fmt=self.exchange)
                 self.save(tag=step, structf=emf)
 
         # Return model-data mismatches
         return self.db.observations.loc[:, ('mismatch', 'err')]
+
+    def storeForward(self, results, step):
+        """
+        Store the results of a forward run (DataFrame with the columns modified by the transport model: at least
+        "foreground", and usually one column per category) in the observation database, and compute the model-data
+        mismatches.
+        """
+        self.forward_columns = list(results.columns)
+        for col in results.columns :
+            self.db.observations.loc[:, col] = results.loc[:, col]
+        self.db.observations.loc[:, 'mismatch'] = \
+            self.db.observations.loc[:,'background'] + \
+            self.db.observations.loc[:,'foreground'] - \
+            self.db.observations.loc[:,'obs']
+        self.db.observations.loc[:, step] = self.db.observations.loc[:, 'background']+self.db.observations.loc[:, 'foreground']
     
     
     def runAdjoint(self, departures):
         """
-        Prepare input for the adjoint run, launch the actual transport model in a subprocess and retrieve the results
-        The eventual parallelization is handled by the subprocess directly
+        Adjoint run: run the transport model (in-process, or through files) for the "departures", and return the
+        adjoint structure.
+        """
+        self.db.observations.loc[:, 'dy'] = departures
+        if self.inprocess :
+            return self.getModel().adjoint(self.db.observations.loc[:, 'dy'])
+
+        rundir = self.rcf.get('path.run')
+        dpf = self.db.save_columns(os.path.join(rundir, 'departures.h5'), ['dy'])
+        adjf = os.path.join(rundir, 'adjoint.mmap' if self.exchange == 'mmap' else 'adjoint.nc')
+        self.execute('adjoint', update=dpf, emis=adjf)
+        return self.readStruct(adjf)
+
+    def runForwardEnsemble(self, structs, step=None):
+        """
+        Forward run for an ensemble of emission structures, done in one pass over the footprints (in-process, or
+        through files). Returns a (nobs x nmembers) DataFrame with the foreground concentrations of each member,
+        indexed by observation id (only the observations with a valid footprint).
         """
-        
+        self.check_init()
+        if self.inprocess :
+            return self.getModel().forwardEnsemble(structs)
+
         rundir = self.rcf.get('path.run')
-        executable = self.rcf.get("model.transport.exec")
-        #fields = self.rcf.get('model.adjoint.obsfields')
+        ensemble = [self.writeStruct(struct, rundir, f'ensemble.{step}.{imember}', fmt=self.exchange) for (imember, struct) in enumerate(structs)]
+        resf = os.path.join(rundir, f'forward_ensemble.{step}.h5')
+        self.execute('forward_ensemble', ensemble=ensemble, output=resf)
+        values = read_columns(resf)
+        values.columns = values.columns.astype(int)
+        return values
 
-        self.db.observations.loc[:, 'dy'] = departures
-        dpf = self.db.save_tar(os.path.join(rundir, 'departures.tar.gz'))
-        
-        # Create an adjoint rc-file
-        rcadj = self.rcf.write(os.path.join(rundir, 'adjoint.rc'))
+    def runAdjointEnsemble(self, departures):
+        """
+        Adjoint run for an ensemble of departures (DataFrame indexed by observation id, with one column per member),
+        done in one pass over the footprints (in-process, or through files). Returns a list of adjoint structures.
+        """
+        if self.inprocess :
+            return self.getModel().adjointEnsemble(departures)
 
-        # Name of the adjoint output file
-        adjf = os.path.join(rundir, 'adjoint.nc')
+        rundir = self.rcf.get('path.run')
+        dpf = save_columns(departures.rename(columns=str), os.path.join(rundir, 'departures_ensemble.h5'))
+        ext = 'mmap' if self.exchange == 'mmap' else 'nc'
+        ensemble = [os.path.join(rundir, f'adjoint.{imember}.{ext}') for imember in range(departures.shape[1])]
+        self.execute('adjoint_ensemble', departures=dpf, ensemble=ensemble)
+        return [self.readStruct(adjf) for adjf in ensemble]
 
-        # Create temporary file
-        checkf = os.path.join(tempfile.mkdtemp(dir=rundir), 'adjoint.ok')
+    def execute(self, cmd, **files):
+        """
+        Run the transport model out of process: send the request to the transport server (started if needed), or, if
+        model.transport.server is disabled, start the model for this run only. "files" are the files (or lists of
+        files) exchanged with the model (command line arguments of the model, without the leading "--").
+        """
+        rundir = self.rcf.get('path.run')
+        dbf = self.stageObs(rundir)
+        if self.use_server :
+            if not self.getServer(dbf).request(cmd=cmd, **files):
+                logger.error(f"Transport request {cmd} failed, exiting ...")
+                sys.exit()
+            return
 
-        # Run the adjoint transport:
-        cmd = ['python', executable, '--adjoint', '--db', dpf, '--rc', rcadj, '--emis', adjf, '--checkfile', checkf]
-        logger.info(colorize(' '.join([x for x in cmd]), 'g'))
-        pid = subprocess.Popen(cmd, close_fds=True)
+        executable = self.rcf.get("model.transport.exec")
+        rcf = self.rcf.write(os.path.join(rundir, f'{cmd}.rc'))
+        checkf = os.path.join(tempfile.mkdtemp(dir=rundir), f'{cmd}.ok')
+        args = ['--rc', rcf, f"--{cmd.replace('_', '-')}", '--db', dbf, '--checkfile', checkf]
+        for key, value in files.items():
+            args.extend([f'--{key}'] + (value if isinstance(value, list) else [value]))
+        logger.info(colorize(' '.join(self.command(executable, *args)), 'g'))
+        pid = subprocess.Popen(self.command(executable, *args), close_fds=True)
         pid.wait()
+        self.check_success(checkf, f"Transport {cmd} run failed, exiting ...")
 
-        self.check_success(checkf, 'Adjoint run failed, exiting ...')
+    def obsKey(self):
+        """
+        Checksum of the observations (index, footprints and times) as seen by the transport model
+        """
+        return hash_pandas_object(self.db.observations.loc[:, ['footprint', 'time']]).sum()
+
+    def stageObs(self, rundir):
+        """
+        Write the observation database in the run directory, if it hasn't been done yet or if the observations have
+        changed since, and return the file name.
+        """
+        filename = os.path.join(rundir, 'observations.%s'%self.dbformat)
+        key = self.obsKey()
+        if self.staged != (filename, key) or not os.path.exists(filename):
+            self.db.save(filename)
+            self.staged = (filename, key)
+        return filename
 
-        # Collect the results :
-        return self.readStruct(rundir, 'adjoint')
+    def getModel(self):
+        """
+        Return the in-process transport model: the "Lagrange" class of the model.transport.exec script is imported and
+        instantiated at the first call, with a copy of the observation database (the model is re-created if the
+        observations change).
+        """
+        key = self.obsKey()
+        if self.model is not None and key != self.model_key :
+            self.close()
+        if self.model is None :
+            self.model_key = key
+            executable = self.rcf.get("model.transport.exec")
+            spec = importlib.util.spec_from_file_location('lumia_transport_model', executable)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            db = obsdb(start=self.db.start, end=self.db.end)
+            db.observations = self.db.observations.copy()
+            db.sites = self.db.sites
+            db.files = self.db.files
+            self.model = module.Lagrange(self.rcf, db, None, mp=not self.rcf.get('model.transport.serial', default=False))
+            logger.info(f"Transport model {executable} loaded in-process")
+        return self.model
+
+    def getServer(self, dbf):
+        """
+        Return the transport server, started at the first call with the observation database "dbf" (it is restarted
+        if the observations change).
+        """
+        key = self.obsKey()
+        if self.server is not None and key != self.model_key :
+            self.close()
+        if self.server is None :
+            self.model_key = key
+            rundir = self.rcf.get('path.run')
+            rcf = self.rcf.write(os.path.join(rundir, 'transport.rc'))
+            self.server = TransportServer(self.command(self.rcf.get("model.transport.exec"), '--serve', '--rc', rcf, '--db', dbf))
+        return self.server
+
+    def close(self):
+        """
+        Stop the in-process transport model or the transport server (and their eventual workers)
+        """
+        if self.model is not None :
+            self.model.close()
+            self.model = None
+        if self.server is not None :
+            self.server.close()
+            self.server = None
+
+    def command(self, executable, *args):
+        """
+        Command line of the transport model. If the "model.transport.mpi" rc-key is set, the model is started on that
+        number of MPI ranks (with the command given by "model.transport.mpirun", "mpirun" by default).
+        """
+        nranks = self.rcf.get('model.transport.mpi', default=0)
+        if nranks :
+            mpirun = self.rcf.get('model.transport.mpirun', default='mpirun').split()
+            return mpirun + ['-n', str(nranks), 'python', executable, '--mpi'] + list(args)
+        return ['python', executable] + list(args)
 
     def check_success(self, checkf, msg):
 
@@ -1,12 +1,72 @@
 #!/usr/bin/env python
 import os
+import pickle
 import logging
-from numpy import zeros, zeros_like, sqrt, inner, nan_to_num, dot
+from collections import OrderedDict
+from hashlib import sha1
+from numpy import zeros, zeros_like, sqrt, inner, nan_to_num, dot, ascontiguousarray
+from pandas.util import hash_pandas_object
 from lumia.minimizers.congrad import Minimizer as congrad
 from .Tools import costFunction
 
 logger = logging.getLogger(__name__)
 
+
+class StateCache:
+    """
+    Content-addressed cache of the transport results (departures and gradients), indexed by a checksum of the
+    (preconditioned) state vector and of the transport configuration, so that a state is never transported twice.
+    Only the results of the last "size" states (by default, the current and the previous iterates) are kept in memory.
+    If a "path" is given, the entries are also stored on disk, and can be reused by restarted inversions.
+    """
+    def __init__(self, path=None, size=2):
+        self.entries = OrderedDict()
+        self.path = path
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        if path is not None and not os.path.exists(path):
+            os.makedirs(path)
+
+    def filename(self, key, field):
+        return os.path.join(self.path, f'{key}.{field}.pkl')
+
+    def store(self, key, field, value):
+        """
+        Keep a value in memory, and drop the least recently used states if there are more than self.size of them
+        """
+        self.entries.setdefault(key, {})[field] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size :
+            self.entries.popitem(last=False)
+
+    def get(self, key, field):
+        """
+        Returns the value stored for the state "key", or None if there is none.
+        """
+        value = self.entries.get(key, {}).get(field)
+        if value is not None :
+            self.entries.move_to_end(key)
+        elif self.path is not None and os.path.exists(self.filename(key, field)):
+            with open(self.filename(key, field), 'rb') as fid :
+                value = pickle.load(fid)
+            self.store(key, field, value)
+        if value is None :
+            self.misses += 1
+        else :
+            self.hits += 1
+        return value
+
+    def put(self, key, field, value):
+        self.store(key, field, value)
+        if self.path is not None :
+            with open(self.filename(key, field), 'wb') as fid :
+                pickle.dump(value, fid)
+
+    def __repr__(self):
+        return f"StateCache({len(self.entries)} states in memory, {self.hits} hits, {self.misses} misses)"
+
+
 class Optimizer(object):
     def __init__(self, rcf, control, obsop, interface, minimizer=congrad):
         self.rcf = rcf                        # Settings
@@ -16,6 +76,13 @@ class Optimizer(object):
         self.interface = interface
         self.iteration = 0
 
+        # Cache of the departures (and gradients) already computed, to avoid transporting the same state twice
+        # (typically, the final state of the minimization is also the last one evaluated in the iterations).
+        self.cache = None
+        if self.rcf.get('var4d.cache', default=True):
+            self.cache = StateCache(self.rcf.get('var4d.cache.path', default=None), self.rcf.get('var4d.cache.size', default=2))
+        self.cache_gradient = self.rcf.get('var4d.cache.gradient', default=True)
+
     def Var4D(self, label='apos'):
         self.minimizer.reset()     # Just to make sure ...
 
@@ -34,6 +101,8 @@ class Optimizer(object):
         self.minimizer.update(gradient_preco, self.J.tot)
         self._calcPosteriorUncertainties()
         self.save(label)
+        if self.cache is not None :
+            logger.info(f"Transport results cache: {self.cache.hits} hits, {self.cache.misses} misses")
 
     def _Var4D_step(self, state_preco, step='apri'):
         dy, err = self._computeDepartures(state_preco, step)
@@ -44,10 +113,33 @@ class Optimizer(object):
         self.iteration += 1
         return state_preco, status
 
+    def _stateKey(self, state_preco):
+        """
+        Checksum of the state vector, of the settings (except the paths) and of the observations
+        """
+        checksum = sha1(ascontiguousarray(state_preco).tobytes())
+        keys = sorted((k, str(v)) for (k, v) in self.rcf.keys.items() if not k.startswith('path.'))
+        checksum.update(str(keys).encode())
+        obs = self.obsop.db.observations
+        checksum.update(hash_pandas_object(obs.loc[:, [c for c in ('obs', 'err', 'background') if c in obs]]).values.tobytes())
+        return checksum.hexdigest()
+
     def _computeDepartures(self, state_preco, step):
-        state = self.control.xc_to_x(state_preco)
-        struct = self.interface.VecToStruct(state)
-        departures = self.obsop.runForward(struct, step=step)
+        cached = None
+        if self.cache is not None :
+            key = self._stateKey(state_preco)
+            cached = self.cache.get(key, 'forward')
+        if cached is None :
+            state = self.control.xc_to_x(state_preco)
+            struct = self.interface.VecToStruct(state)
+            departures = self.obsop.runForward(struct, step=step)
+            if self.cache is not None :
+                results = self.obsop.db.observations.loc[:, self.obsop.forward_columns].copy()
+                self.cache.put(key, 'forward', (departures, results))
+        else :
+            logger.info(f"State already transported, the forward run is skipped ({self.cache})")
+            departures, results = cached
+            self.obsop.storeForward(results, step)
         dy = departures.loc[:, 'mismatch']
         dye = departures.loc[:, 'err']
         return dy, dye
@@ -61,14 +153,25 @@ class Optimizer(object):
         return J
 
     def _ComputeGradient(self, state_preco, dy, dye):
-        adjoint_struct = self.obsop.runAdjoint(dy/dye**2)
-        adjoint_state = self.interface.VecToStruct_adj(adjoint_struct)
-        gradient_obs_preco = self.control.g_to_gc(adjoint_state)
+        cached = None
+        if self.cache is not None and self.cache_gradient :
+            key = self._stateKey(state_preco)
+            cached = self.cache.get(key, 'gradient')
+        if cached is None :
+            adjoint_struct = self.obsop.runAdjoint(dy/dye**2)
+            adjoint_state = self.interface.VecToStruct_adj(adjoint_struct)
+            gradient_obs_preco = self.control.g_to_gc(adjoint_state)
+            x_adj = sum(adjoint_state), sum(adjoint_struct['biosphere']['emis']).sum()
+            if self.cache is not None and self.cache_gradient :
+                self.cache.put(key, 'gradient', (gradient_obs_preco, x_adj))
+        else :
+            logger.info(f"State already transported, the adjoint run is skipped ({self.cache})")
+            gradient_obs_preco, x_adj = cached
         state_departures = state_preco-self.control.get('state_prior_preco')
         gradient_preco = gradient_obs_preco + state_departures
         mode = 'w' if self.iteration == 0 else 'a'
         with open(os.path.join(self.rcf.get('path.output'), 'costFunction.txt'), mode=mode) as fid :
-            fid.write(f"iter {self.iteration}: J_obs = {self.J.obs}; J_bg = {self.J.bg}; dJ_obs={sum(gradient_obs_preco)}; dJ_bg={sum(state_departures)}; x_adj={sum(adjoint_state), sum(adjoint_struct['biosphere']['emis']).sum()} \n")
+            fid.write(f"iter {self.iteration}: J_obs = {self.J.obs}; J_bg = {self.J.bg}; dJ_obs={sum(gradient_obs_preco)}; dJ_bg={sum(state_departures)}; x_adj={x_adj} \n")
         return gradient_preco
 
     def _calcPosteriorUncertainties(self, store_eigenvec=False):
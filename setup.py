@@ -19,7 +19,7 @@ setuptools.setup(
             "License :: OSI Approved :: European Union Public Licence 1.2 (EUPL 1.2)",
             "Operating System :: OS Independent",
         ],
-        python_requires='>=3.6',
+        python_requires='>=3.8',
         scripts=['scripts/var4d.py', 'scripts/lagrange_mp.py'],
         data_files=[('bin',['src/congrad/congrad.exe'])]
 )
@@ -1,15 +1,23 @@
 #!/usr/bin/env python
 
-import os, sys, subprocess, tempfile, operator, h5py, shutil
+import os, sys
+import json
 from lumia.Tools import rctools
 from lumia.obsdb import obsdb
-from lumia.Tools.logging_tools import colorize
-from lumia.formatters.lagrange import ReadStruct, Struct, WriteStruct, CreateStruct
-from numpy import unique, array
+from lumia.obsdb.columnar import save_columns, read_columns
+from lumia.formatters.lagrange import ReadStruct, WriteStruct, CreateStruct
+from numpy import array, arange, concatenate, zeros, ma, nan, ascontiguousarray, load, savez
+from pandas import Series, DataFrame
+from pandas.util import hash_pandas_object
+from hashlib import sha1
 from lumia import tqdm
+from lumia.footprints import SparseOperator, FootprintPool, FootprintCache
+from lumia.footprints.scheduler import partition, available_cpus
+from lumia.footprints.kernels import iter_blocks, forward_block, stack_emis, AdjointAccumulator
+from lumia.footprints.footprint import timesIndex
 from argparse import ArgumentParser, REMAINDER
 from datetime import datetime
-from lumia.Tools.time_tools import tinterv, time_interval
+from lumia.Tools.time_tools import time_interval
 from lumia.Tools import Region
 from lumia.Tools import Categories
 
@@ -19,282 +27,434 @@ logger = logging.getLogger(__name__)
 
 # Clean(er/ish) disabling of tqdm in batch mode
 # If the "INTERACTIVE" environment variable is defined and set to "F", we redefine tqdm with the following dummy function
-if os.environ['INTERACTIVE'] == 'F':
+if os.environ.get('INTERACTIVE') == 'F':
     def tqdm(iterable, *args, **kwargs):
         return iterable
 
 
-class Footprint:
-    def __init__(self, fpfile, path='', open=True):
-        self.filename = fpfile
-        if not os.path.exists(self.filename):
-            logger.warning('Footprint file not found: %s'%self.filename)
-        self.ds = h5py.File(fpfile, 'r')
-        self.varname = None
-
-    def close(self):
-        self.ds.close()
-
-    def loadObs(self, time):
-        self.varname = time.strftime('%Y%m%d%H%M%S')
-        if not self.varname in self.ds.keys() :
-            return None
-        times = self.ds[self.varname].keys()
-        data = {}
-        for tt in times :
-            t1, t2 = tt.split('_')
-            t1 = datetime.strptime(t1, '%Y%m%d%H%M%S')
-            t2 = datetime.strptime(t2, '%Y%m%d%H%M%S')
-            if t2 < t1 :
-            # Some files may contain fields as tmin_tmax, which shouldn't be used (old and wrong!)
-                ttint = tinterv(t2, t1)
-                ttint.varname = self.varname
-                data[ttint] = self.ds[self.varname][tt]
-        return data
-
-    def applyEmis(self, time, emis, categories=None, scalefac=1.):
-        fp = self.loadObs(time)
-        if fp is None : return None, None
-        if categories is None: categories = emis.keys()
-        dym = {}
-        fptot = 0.
-        for cat in categories :
-            times_cat = [tinterv(t1, t2) for (t1, t2) in zip(emis[cat]['time_interval']['time_start'], emis[cat]['time_interval']['time_end'])]
-            dym[cat] = 0.
-            fptot = 0.
-            for tt in sorted(fp, key=operator.attrgetter('start')):
-                try :
-                    ilats = fp[tt]['ilats'][:]
-                    ilons = fp[tt]['ilons' ][:]
-                except KeyError :
-                    try :
-                        ilats = fp[tt]['ilat'][:]
-                        ilons = fp[tt]['ilon' ][:]
-                    except KeyError :
-                        logger.error(f"Error reading ilats/ilons from footprint {tt.varname} in file {self.filename}")
-                        raise KeyError 
-                try :
-                    dyc = (emis[cat]['emis'][times_cat.index(tt), ilats, ilons]*fp[tt]['resp'][:]).sum()*scalefac
-                    dym[cat] += dyc
-                    fptot += fp[tt]['resp'][:].sum()
-                except ValueError :
-                    # This may happen if the footprints and the fluxes are not on the same temporal resolution
-                    # (and the footprint files have been generated by an idiot, a.k.a me)
-                    # Or just the first observations, too close to the start of the emissions ...
-                    return None, None
-                except IndexError :
-                    print(self.filename)
-                    print(time)
-                    print(tt, ilats, ilons)
-                    print(times_cat)
-                    print(fp.keys())
-
-        return dym, fptot
-
-    def applyAdjoint(self, time, dy, adjEmis, cats, scalefac=1.):
-        fp = self.loadObs(time)
-        if fp is None : return adjEmis
-        for cat in cats :
-            times_cat = [tinterv(t1, t2) for (t1, t2) in zip(adjEmis[cat]['time_interval']['time_start'], adjEmis[cat]['time_interval']['time_end'])]
-            for tt in sorted(fp, key=operator.attrgetter('end')):
-                try :
-                    ilats = fp[tt]['ilat'][:]
-                    ilons = fp[tt]['ilon'][:]
-                except KeyError :
-                    ilats = fp[tt]['ilats'][:]
-                    ilons = fp[tt]['ilons'][:]
-                try :
-                    adjEmis[cat]['emis'][times_cat.index(tt), ilats, ilons] += fp[tt]['resp'][:]*dy*scalefac
-                except ValueError :
-                    return adjEmis
-        return adjEmis
-
 class Lagrange:
-    def __init__(self, rcf, obs, emfile, mp=False, checkfile=None):
-        self.rcf = rctools.rc(rcf)
-        self.obs = obsdb(obs)
+    def __init__(self, rcf, obs, emfile, mp=False, checkfile=None, mpi=False):
+        # The settings and observations can be passed either as file names, or directly as rc and obsdb objects
+        # (when the model runs in the same process as the optimizer)
+        self.rcf = rcf if isinstance(rcf, rctools.rc) else rctools.rc(rcf)
+        self.obs = obs if isinstance(obs, obsdb) else obsdb(obs)
         self.obs.checkIndex(reindex=True)
-        self.obsfile = obs
+        self.obs.compact()
+        self.obsfile = obs if isinstance(obs, str) else None
         self.rcfile = rcf
         self.emfile = emfile
-        self.executable = __file__
-        self.batch = os.environ['INTERACTIVE'] == 'F'
+        self.batch = os.environ.get('INTERACTIVE') == 'F'
         self.categories = Categories(self.rcf)
         self.checkfile=checkfile
         logger.debug(checkfile)
-        if mp :
+
+        # Optional in-memory footprint cache, so that the footprints are read only once per run (the size is in MB,
+        # and is split between the workers in parallel runs)
+        self.cache_size = self.rcf.get('model.transport.cache.size', default=0)*1.e6
+        self.cache_compression = self.rcf.get('model.transport.cache.compression', default=False) or None
+        self.cache = FootprintCache(self.cache_size, self.cache_compression) if self.cache_size else None
+
+        # Number of footprint files read in advance (in a background thread) during the transport runs
+        self.prefetch = self.rcf.get('model.transport.prefetch', default=1)
+
+        # The contributions of the categories that are not optimized are computed only once, and then stored in
+        # self.fixed_file (next to the observation database by default), from which they are read in the next runs.
+        self.fixed_file = None
+        self.fixed_key = None
+        if self.rcf.get('model.transport.cache.fixed', default=True):
+            path = os.path.dirname(os.path.abspath(self.obsfile)) if self.obsfile else self.rcf.get('path.run')
+            default = os.path.join(path, 'transport.fixed.npz')
+            self.fixed_file = self.rcf.get('model.transport.cache.fixed.file', default=default)
+
+        # Mapping of the footprint time steps to the emission time axis, shared by the forward and adjoint runs
+        tstart, tend = self.emisTimes()
+        self.times_index = timesIndex(tstart, tend)
+
+        # The workers are started only at the first transport run, and then stay alive until self.close() is called
+        # The number of workers is set by the model.transport.split key, or by the number of available CPUs if absent
+        # With "mpi", the footprints are instead distributed over the ranks of MPI.COMM_WORLD (see lumia.footprints.mpi)
+        self.pool = None
+        self.mpi = mpi
+        self.nworkers = self.rcf.get('model.transport.split', default=available_cpus())
+        if mpi or (mp and self.nworkers > 1) :
             self.parallel = True
-            self.runForward = self.runForward_mp
-            self.runAdjoint = self.runAdjoint_mp
+            self.forwardStacked = self.forward_mp
+            self.adjointField = self.adjoint_mp
         else :
             self.parallel = False
-            self.runForward = self.runForward_sp
-            self.runAdjoint = self.runAdjoint_sp
-
-    def runForward_sp(self):
-        # Read the emissions:
-        emis = ReadStruct(self.emfile)
-
-        # Create containers
-        dy = {}
-        dy['tot'] = []
-        dy['id'] = []
-        dy['model'] = []
-        for cat in self.categories.list :
-            dy[cat] = []
+            self.forwardStacked = self.forward_sp
+            self.adjointField = self.adjoint_sp
+
+        # If a precompiled observation operator is available, use it instead of reading the footprints.
+        # Since it is fast, there is no point in distributing the run on several workers.
+        self.operator = None
+        opfile = self.rcf.get('model.transport.operator', default=False)
+        if opfile and os.path.exists(opfile):
+            self.loadOperator(opfile)
+        if self.operator is not None :
+            self.forwardStacked = self.forward_H
+            self.adjointField = self.adjoint_H
+
+    def emisTimes(self):
+        """
+        Return the start and end of the emission time steps (as arrays of datetime objects)
+        """
+        start = datetime(*self.rcf.get('time.start'))
+        end = datetime(*self.rcf.get('time.end'))
+        dt = time_interval(self.rcf.get('emissions.*.interval'))
+        times = arange(start, end, dt, dtype=datetime)
+        return times, array(times)+dt
 
-        # Loop over the footprint files
-        nsites = len(unique(self.obs.observations.footprint.dropna()))
-        msg = 'Forward run'
-        for fpfile in tqdm(unique(self.obs.observations.footprint.dropna()), total=nsites, desc=msg, disable=self.batch, leave=False):
-            fp = Footprint(fpfile)
-
-            # Loop over the obs in the file
-            msg = "Forward run (%s)"%fpfile
-            nobs = sum(self.obs.observations.footprint == fpfile)
-            for obs in tqdm(self.obs.observations.loc[self.obs.observations.footprint == fpfile, :].itertuples(), desc=msg, leave=False, total=nobs, disable=self.batch):
-                dym, tot = fp.applyEmis(obs.time, emis)
-                if dym is not None :
-                    for cat in self.categories.list :
-                        dy[cat].append(dym.get(cat))
-                    dy['tot'].append(tot)
-                    dy['id'].append(obs.Index)
-                    dy['model'].append(dym)
-            fp.close()
+    def emisShape(self):
+        region = Region(self.rcf)
+        return len(self.emisTimes()[0]), region.nlat, region.nlon
 
-        try :
-            self.obs.observations.loc[dy['id'], 'id'] = dy['id']
-        except :
-            import pdb; pdb.set_trace()
-        self.obs.observations.loc[dy['id'], 'totals'] = dy['tot']
-        self.obs.observations.loc[dy['id'], 'model'] = dy['model']
-        self.obs.observations.loc[:, 'foreground'] = 0.
-        for cat in self.categories.list :
-            self.obs.observations.loc[dy['id'], cat] = dy[cat]
-            self.obs.observations.loc[dy['id'], 'foreground'] += array(dy[cat])
-        
-        # Write db:
-        self.obs.save_tar(self.obsfile)
-
-    def runForward_mp(self):
-        files = self.RunParallel('--forward')
-
-        # Retrieve the data
-        for dbf in files :
-            db = obsdb(dbf)
-            self.obs.observations.loc[db.observations.index, 'foreground'] = db.observations.loc[:, 'foreground']
-            self.obs.observations.loc[db.observations.index, 'totals'] = db.observations.loc[:, 'totals']
-            self.obs.observations.loc[db.observations.index, 'model'] = db.observations.loc[:, 'model']
-            for cat in self.categories.list:
-                self.obs.observations.loc[db.observations.index, cat] = db.observations.loc[:, cat]
-            os.remove(dbf)
-        self.obs.save_tar(self.obsfile)
-
-    def runAdjoint_sp(self):
-        # Create an empty adjoint structure:
+    def createAdjoint(self):
+        """
+        Create an empty adjoint structure, for the optimized categories
+        """
         region = Region(self.rcf)
         categories = [c for c in self.rcf.get('emissions.categories') if self.rcf.get('emissions.%s.optimize'%c) == 1]
         start = datetime(*self.rcf.get('time.start'))
         end = datetime(*self.rcf.get('time.end'))
         dt = time_interval(self.rcf.get('emissions.*.interval'))
-        adj = CreateStruct(categories, region, start, end, dt)
+        return CreateStruct(categories, region, start, end, dt)
 
-        # Loop over the footprint files:
-        db = self.obs.observations
-        files = unique(db.footprint.dropna())
-        for fpfile in tqdm(files, total=len(files), desc='Adjoint run', leave=False, disable=self.batch):
-            fp = Footprint(fpfile)
-            msg = f"Adjoint run {fpfile}"
-
-            # Loop over the obs in the file
-            for obs in tqdm(db.loc[db.footprint == fpfile, :].itertuples(), desc=msg, leave=False, disable=self.batch):
-                adj = fp.applyAdjoint(obs.time, obs.dy, adj, categories)
-            fp.close()
-
-        # Write the adjoint field
-        WriteStruct(adj, self.emfile)
-
-    def runAdjoint_mp(self):
-        files = self.RunParallel('--adjoint')
+    def buildOperator(self, filename):
+        """
+        Compile the footprints of all the observations in the database in a sparse observation operator, and store it.
+        """
+        region = Region(self.rcf)
+        tstart, tend = self.emisTimes()
+        op = SparseOperator.build(self.obs.observations, tstart, tend, region.nlat, region.nlon, disable_pbar=self.batch)
+        return op.save(filename)
 
-        # Retrieve the data
-        adj = Struct()
-        for adjf in files :
-            adj += ReadStruct(adjf)
-            os.remove(adjf)
+    def loadOperator(self, filename):
+        region = Region(self.rcf)
+        tstart, tend = self.emisTimes()
+        op = SparseOperator.load(filename)
+        if not op.conforms(tstart, tend, region.nlat, region.nlon):
+            logger.warning(f"The observation operator in {filename} doesn't match the emission grid, it will not be used")
+            return
+        self.operator_ids = op.restrict(self.obs.observations)
+        self.operator = op
+
+    def runForward(self, output=None):
+        """
+        Forward run: read the emissions from self.emfile, and write the results in the observation database, or only
+        the columns modified by the forward run in the "output" file, if provided.
+        """
+        emis = ReadStruct(self.emfile)
+        self.storeForward(self.forward(emis))
+        if output is None :
+            self.obs.save(self.obsfile)
+        else :
+            self.obs.save_columns(output, self.forwardColumns())
 
+    def runAdjoint(self):
+        """
+        Adjoint run: read the departures from the observation database, and write the adjoint field in self.emfile
+        """
+        adj = self.adjoint(self.obs.observations.dy)
         WriteStruct(adj, self.emfile)
 
-    def RunParallel(self, step):
-        pids = []
-        files = []
-        checkfiles = []
-        for idb, dbf in enumerate(self.splitDb()):
-            # If it's an adjoint run, we also need a name for the adjoint file:
-            if step == '--adjoint':
-                emfile = dbf.replace('obs', 'adjoint')
-                files.append(emfile)
-            else :
-                emfile = self.emfile
-                files.append(dbf)
-
-            # Launch the transport subprocesses
-            cmd = ['python', self.executable, step, '--db', dbf, '--rc', self.rcfile, '--emis', emfile, '--serial']
-            if self.checkfile is not None :
-                cf = f'{self.checkfile}.{idb}'
-                cmd += ['-c', cf]
-                checkfiles.append(cf)
-            logger.info(colorize(' '.join([x for x in cmd]), 'g'))
-            pids.append(subprocess.Popen(cmd, close_fds=True))
-
-        # Let the subprocesses finish
-        sigterm = [x.wait() for x in pids]
-
-        # Check success
-        self.check_success(checkfiles)
-
-        # Return a list with the file names :
-        return files
-
-    def splitDb(self):
-        nobs = self.obs.observations.shape[0]
-        nchunks = self.rcf.get('model.transport.split', default=1)
-
-        logger.debug(f"The database will be split in {nchunks} chunks")
-
-        # If we run on just one CPU, don't go further, run on the current file
-        if nchunks == 1 :
-            yield self.obsfile
-
+    def runForwardEnsemble(self, ensemble, output):
+        """
+        Ensemble forward run: read the emissions of the members from the "ensemble" files, and write their
+        (nobs x nmembers) foreground concentrations in the "output" file (columnar format, one column per member)
+        """
+        values = self.forwardEnsemble([ReadStruct(filename) for filename in ensemble])
+        save_columns(values.rename(columns=str), output)
+
+    def runAdjointEnsemble(self, departures, ensemble):
+        """
+        Ensemble adjoint run: read the departures of the members from the "departures" file (columnar format, one
+        column per member), and write the adjoint structure of each member in the corresponding "ensemble" file
+        """
+        dy = read_columns(departures)
+        for adj, filename in zip(self.adjointEnsemble(dy), ensemble):
+            WriteStruct(adj, filename)
+
+    def execute(self, request):
+        """
+        Run a request of the transport server (see self.serve): a dictionary with the command ("forward", "adjoint",
+        "forward_ensemble" or "adjoint_ensemble") and the files to use ("emis", "ensemble", "departures", "update" and
+        "output", as the command line arguments).
+        """
+        if request.get('update') is not None :
+            self.obs.update_columns(request['update'])
+        self.emfile = request.get('emis', self.emfile)
+        if request['cmd'] == 'forward' :
+            self.runForward(output=request.get('output'))
+        elif request['cmd'] == 'adjoint' :
+            self.runAdjoint()
+        elif request['cmd'] == 'forward_ensemble' :
+            self.runForwardEnsemble(request['ensemble'], request['output'])
+        elif request['cmd'] == 'adjoint_ensemble' :
+            self.runAdjointEnsemble(request['departures'], request['ensemble'])
         else :
-            chunk_size = int(nobs/nchunks)
-            remain = nobs%nchunks
-            if remain != 0 : chunk_size += 1
-            for ichunk in range(nchunks):
-                logger.debug(f"Extract chunk {ichunk}, from iloc {ichunk*chunk_size} to {(ichunk+1)*chunk_size}")
-                logger.debug(f"Database size: {nobs} rows")
-
-                db = self.obs.get_iloc(slice(ichunk*chunk_size, (ichunk+1)*chunk_size))
+            raise ValueError(f"Unknown transport request: {request['cmd']}")
+
+    def serve(self, requests, replies):
+        """
+        Server mode: execute the requests read from "requests" (one JSON dictionary per line), and write "ok" or
+        "error" in "replies" after each of them, until a "stop" request (or the end of the input). The workers and the
+        footprint caches are kept alive between the requests.
+        """
+        for line in requests :
+            request = json.loads(line)
+            if request['cmd'] == 'stop' :
+                break
+            try :
+                self.execute(request)
+                reply = 'ok'
+            except Exception :
+                logger.exception(f"Transport request {request} failed")
+                reply = 'error'
+            replies.write(reply + '\n')
+            replies.flush()
+
+    def forward(self, emis):
+        """
+        Forward run for all the categories. The contributions of the non-optimized categories are read from
+        self.fixed_file if it matches the emissions and the observations, otherwise they are computed and stored there.
+        """
+        categories = self.categories.list
+        fixed = [cat for cat in categories if not self.categories[cat].optimize] if self.fixed_file else []
+        if len(fixed) == 0 :
+            return self.formatForward(*self.forwardCategories(emis, categories))
+
+        key = self.fixedKey(emis, fixed)
+        cached = self.loadFixed(key)
+        if cached is None :
+            ids, totals, values = self.forwardCategories(emis, categories)
+            self.saveFixed(key, ids, totals, values[:, [categories.index(cat) for cat in fixed]])
+            return self.formatForward(ids, totals, values)
+
+        # Only compute the optimized categories
+        optimized = [cat for cat in categories if cat not in fixed]
+        logger.info(f"Contributions of the {', '.join(fixed)} categories read from {self.fixed_file}")
+        cids, ctotals, cvalues = cached
+        if len(optimized) == 0 :
+            return self.formatForward(cids, ctotals, cvalues)
+        ids, totals, opt = self.forwardCategories(emis, optimized)
+        pos = Series(arange(len(cids)), index=cids).reindex(ids)
+        if pos.isna().any():
+            logger.warning(f"{self.fixed_file} doesn't cover all the observations, the fixed categories are recomputed")
+            os.remove(self.fixed_file)
+            return self.forward(emis)
+        values = zeros((len(ids), len(categories)))
+        values[:, [categories.index(cat) for cat in optimized]] = opt
+        values[:, [categories.index(cat) for cat in fixed]] = cvalues[pos.values.astype(int)]
+        return self.formatForward(ids, totals, values)
+
+    def forwardCategories(self, emis, categories):
+        """
+        Forward run for the requested categories of the "emis" structure. Returns the ids of the observations with a
+        valid footprint, their footprint totals and their (nobs x ncat) concentrations.
+        """
+        return self.forwardStacked(stack_emis(emis, categories))
+
+    def adjoint(self, dy):
+        """
+        Adjoint run for the departures "dy" (pandas Series, indexed by observation id). Returns an adjoint structure,
+        with the same field for all the optimized categories.
+        """
+        adj = self.createAdjoint()
+        field = self.adjointField(dy)
+        for cat in adj :
+            adj[cat]['emis'][:] = field
+        return adj
+
+    def forwardEnsemble(self, members):
+        """
+        Forward run for an ensemble of emission structures, done in one pass over the footprints.
+        Returns a (nobs x nmembers) DataFrame with the foreground concentrations (sum of all the categories) of each
+        member, indexed by observation id.
+        """
+        categories = self.categories.list
+        E = concatenate([stack_emis(emis, categories) for emis in members])
+        ids, totals, values = self.forwardStacked(E)
+        values = values.reshape(len(ids), len(members), len(categories)).sum(axis=2)
+        return DataFrame(values, index=ids)
+
+    def adjointEnsemble(self, dy):
+        """
+        Adjoint run for an ensemble of departures, done in one pass over the footprints. "dy" is a DataFrame indexed by
+        observation id, with one column per member. Returns a list of adjoint structures (one per member).
+        """
+        fields = self.adjointField(dy)
+        members = []
+        for field in fields :
+            adj = self.createAdjoint()
+            for cat in adj :
+                adj[cat]['emis'][:] = field
+            members.append(adj)
+        return members
+
+    def fixedKey(self, emis, categories):
+        """
+        Checksum of the emissions of the (non-optimized) categories, of the emission time axis, of the footprints and
+        times of the observations, and of the modification time and size of the footprint files, used to check that
+        the stored contributions are still valid. Since the non-optimized emissions don't change during an inversion,
+        the checksum is computed only once per run (i.e. at the first forward run of the model).
+        """
+        if self.fixed_key is not None and self.fixed_key[0] == categories :
+            return self.fixed_key[1]
+        checksum = sha1()
+        for cat in categories :
+            checksum.update(cat.encode())
+            checksum.update(ascontiguousarray(ma.filled(emis[cat]['emis'], nan)).tobytes())
+        for times in self.emisTimes():
+            checksum.update(str(list(times)).encode())
+        checksum.update(hash_pandas_object(self.obs.observations.loc[:, ['footprint', 'time']]).values.tobytes())
+
+        # Footprint files regenerated under the same name must invalidate the stored contributions
+        for fpfile in sorted(self.obs.observations.footprint.dropna().unique()):
+            stat = os.stat(fpfile) if os.path.exists(fpfile) else None
+            checksum.update(f'{fpfile}:{None if stat is None else (stat.st_mtime, stat.st_size)}'.encode())
+
+        key = '%s:%s'%(','.join(categories), checksum.hexdigest())
+        self.fixed_key = (categories, key)
+        return key
+
+    def loadFixed(self, key):
+        """
+        Returns the observation ids, footprint totals and contributions of the non-optimized categories, as stored in
+        self.fixed_file, or None if that file doesn't exist or doesn't match the current run.
+        """
+        if not os.path.exists(self.fixed_file):
+            return None
+        with load(self.fixed_file) as fid :
+            if str(fid['key']) != key :
+                logger.info(f"{self.fixed_file} doesn't match the current emissions, observations or footprints, it will be overwritten")
+                return None
+            return fid['ids'], fid['totals'], fid['values']
+
+    def saveFixed(self, key, ids, totals, values):
+        savez(self.fixed_file, key=key, ids=array(ids, dtype=int), totals=totals, values=values)
+        logger.info(f"Contributions of the non-optimized categories stored in {self.fixed_file}")
+
+    def forwardResults(self, emis):
+        """
+        Forward run, for in-process use: returns the columns of the observation database modified by the forward run
+        """
+        self.storeForward(self.forward(emis))
+        return self.obs.observations.loc[:, self.forwardColumns()]
+
+    def forwardColumns(self):
+        """
+        Columns of the observation database set by the forward run
+        """
+        return ['totals', 'foreground'] + self.categories.list
+
+    def storeForward(self, dy):
+        """
+        Store the results of a forward run in the observation database
+        """
+        try :
+            self.obs.observations.loc[dy['id'], 'id'] = dy['id']
+        except Exception :
+            logger.exception("The forward run returned observation ids that are not in the database")
+            raise
+        self.obs.observations.loc[dy['id'], 'totals'] = dy['tot']
+        self.obs.observations.loc[:, 'foreground'] = 0.
+        for cat in self.categories.list :
+            self.obs.observations.loc[dy['id'], cat] = dy[cat]
+            self.obs.observations.loc[dy['id'], 'foreground'] += array(dy[cat])
 
-                # Write observation file
-                dbfid, dbf = tempfile.mkstemp(dir=self.rcf.get('path.run'), prefix='obs.', suffix='.tar.gz')
+    def formatForward(self, ids, totals, values):
+        """
+        Convert the (nobs x ncat) array returned by the forward kernels to the format expected by self.storeForward
+        """
+        dy = {'id': list(ids), 'tot': totals}
+        for icat, cat in enumerate(self.categories.list) :
+            dy[cat] = values[:, icat]
+        return dy
 
-                # The previous function actually creates a file. We need to remove it or we end up with too many open files
-                os.fdopen(dbfid).close()
+    def forward_sp(self, E):
+        task = partition(self.obs.observations, 1)[0]
 
-                # Save the file
-                db.save_tar(dbf)
+        # Loop over the footprint files
+        ids, totals, values = [], [], []
+        blocks = iter_blocks(task, self.times_index, self.emisShape(), self.cache, self.prefetch)
+        for fids, block in tqdm(blocks, total=len(task), desc='Forward run', disable=self.batch, leave=False):
+            tot, val = forward_block(block, E)
+            ids.extend(fids[block.valid])
+            totals.extend(tot)
+            values.append(val)
+        values = concatenate(values) if len(values) > 0 else zeros((0, E.shape[0]))
+        self.logCacheStats()
+        return array(ids, dtype=int), array(totals), values
+
+    def forward_mp(self, E):
+        ids, totals, values = self.getPool().forward(E)
+        self.logCacheStats()
+        return ids, totals, values
+
+    def forward_H(self, E):
+        return self.operator_ids, self.operator.totals, self.operator.apply(E)
+
+    def adjoint_sp(self, dy):
+        acc = AdjointAccumulator(self.emisShape(), nmembers=dy.shape[1] if dy.ndim == 2 else None)
+        task = partition(self.obs.observations, 1)[0]
 
-                yield dbf
+        # Loop over the footprint files:
+        blocks = iter_blocks(task, self.times_index, self.emisShape(), self.cache, self.prefetch)
+        for fids, block in tqdm(blocks, total=len(task), desc='Adjoint run', leave=False, disable=self.batch):
+            acc.add(block, dy.loc[fids].values)
+
+        self.logCacheStats()
+        return acc.result()
+
+    def adjoint_mp(self, dy):
+        field = self.getPool().adjoint(dy)
+        self.logCacheStats()
+        return field
+
+    def adjoint_H(self, dy):
+        return self.operator.adjoint(dy.loc[self.operator_ids].values)
+
+    def getPool(self):
+        """
+        Return the pool of transport workers (and start it if needed)
+        """
+        if self.pool is None and self.mpi :
+            from lumia.footprints.mpi import MPIFootprintPool
+            from mpi4py import MPI
+            self.pool = MPIFootprintPool(
+                self.obs.observations, self.times_index, self.emisShape(),
+                cache_size=self.cache_size/MPI.COMM_WORLD.Get_size(), compression=self.cache_compression, prefetch=self.prefetch
+            )
+        elif self.pool is None :
+            self.pool = FootprintPool(
+                self.obs.observations, self.times_index, self.emisShape(), self.nworkers,
+                cache_size=self.cache_size/self.nworkers, compression=self.cache_compression, prefetch=self.prefetch
+            )
+        return self.pool
+
+    def cacheStats(self):
+        """
+        Return the hits/misses statistics of the footprint cache(s), or None if no cache is used
+        """
+        if self.pool is not None :
+            return self.pool.cacheStats()
+        if self.cache is not None :
+            return self.cache.stats()
+
+    def logCacheStats(self):
+        stats = self.cacheStats()
+        if stats is not None :
+            logger.info(f"Footprint cache: {stats['hits']} hits, {stats['misses']} misses, {stats['nblocks']} blocks ({stats['nbytes']/1.e6:.1f} MB)")
 
-    def check_success(self, files):
-        for file in files :
-            if file is not None :
-                if os.path.exists(file) :
-                    os.remove(file)
-                else :
-                    logger.error("Forward run failed, exiting ...")
-                    raise 
+    def close(self):
+        if self.pool is not None :
+            self.pool.close()
+            self.pool = None
+        elif self.mpi :
+            # Release the other MPI ranks, even though they haven't been used
+            from lumia.footprints.mpi import shutdown
+            shutdown()
 
 if __name__ == '__main__':
     logger = logging.getLogger(os.path.basename(__file__))
@@ -303,23 +463,64 @@ if __name__ == '__main__':
     p = ArgumentParser()
     p.add_argument('--forward', '-f', action='store_true', default=False, help="Do a forward run")
     p.add_argument('--adjoint', '-a', action='store_true', default=False, help="Do an adjoint run")
-    p.add_argument('--serial', '-s', action='store_true', default=False, help="Run on a single CPU")
+    p.add_argument('--forward-ensemble', action='store_true', default=False, help="Do a forward run for the emissions of the --ensemble files (results written in the --output file)")
+    p.add_argument('--adjoint-ensemble', action='store_true', default=False, help="Do an adjoint run for the --departures columns (results written in the --ensemble files)")
+    p.add_argument('--serial', '-s', action='store_true', default=False, help="Run on a single CPU (i.e. don't start transport workers)")
+    p.add_argument('--build-operator', '-b', action='store_true', default=False, help="Compile the footprints in a sparse observation operator (stored in the file given by the model.transport.operator rc-key)")
+    p.add_argument('--mpi', action='store_true', default=False, help="Distribute the footprints over the MPI ranks (run with mpirun)")
+    p.add_argument('--serve', action='store_true', default=False, help="Keep running, and execute the requests read on stdin (see Lagrange.serve)")
     p.add_argument('--checkfile', '-c')
     p.add_argument('--rc')
     p.add_argument('--db', required=True)
-    p.add_argument('--emis', required=True)
+    p.add_argument('--update', help="File with observation columns (e.g. departures) to merge in the database (see obsdb.save_columns)")
+    p.add_argument('--output', help="Write only the columns modified by the forward run in that file, instead of updating the database")
+    p.add_argument('--emis')
+    p.add_argument('--ensemble', nargs='+', help="Emission (or adjoint) files of the members of an ensemble run")
+    p.add_argument('--departures', help="Departures of the members of an ensemble adjoint run (see columnar.save_columns)")
     p.add_argument('--verbosity', '-v', default='INFO')
     p.add_argument('args', nargs=REMAINDER)
     args = p.parse_args(sys.argv[1:])
 
     logger.setLevel(args.verbosity)
 
-    # Create the transport model
-    model = Lagrange(args.rc, args.db, args.emis, mp=not args.serial, checkfile=args.checkfile)
+    # In server mode, the standard output is reserved for the replies to the requests: everything else goes to stderr
+    if args.serve :
+        replies = os.fdopen(os.dup(1), 'w')
+        os.dup2(2, 1)
+        sys.stdout = sys.stderr
+
+    # In MPI mode, only rank 0 creates the transport model, the other ranks just wait for instructions
+    if args.mpi :
+        from mpi4py import MPI
 
+        # An uncaught exception on any rank would otherwise leave the other ranks waiting forever
+        def abort(*exc):
+            sys.__excepthook__(*exc)
+            MPI.COMM_WORLD.Abort(1)
+        sys.excepthook = abort
+
+        if MPI.COMM_WORLD.Get_rank() > 0 :
+            from lumia.footprints.mpi import serve
+            serve()
+            sys.exit(0)
+
+    # Create the transport model
+    model = Lagrange(args.rc, args.db, args.emis, mp=not args.serial, checkfile=args.checkfile, mpi=args.mpi)
+    if args.update is not None :
+        model.obs.update_columns(args.update)
+
+    if args.build_operator :
+        model.buildOperator(model.rcf.get('model.transport.operator'))
+    if args.serve :
+        model.serve(sys.stdin, replies)
     if args.forward :
-        model.runForward()
+        model.runForward(output=args.output)
     if args.adjoint :
         model.runAdjoint()
+    if args.forward_ensemble :
+        model.runForwardEnsemble(args.ensemble, args.output)
+    if args.adjoint_ensemble :
+        model.runAdjointEnsemble(args.departures, args.ensemble)
+    model.close()
     if args.checkfile is not None :
         open(args.checkfile, 'w').close()